@@ -1,33 +1,35 @@
 from flask import Flask
 from config import Config
-from extensions import db, mail, login_manager
+from extensions import db, engine_profile, mail, outbox, login_manager, llm_gateway, response_cache, task_queue, query_counter, metrics, cache
 from routes import app_routes
-from sqlalchemy import text
+import migrations
+from database import engine_options
 
 def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app.config["SQLALCHEMY_DATABASE_URI"], app.config["SQLALCHEMY_ENGINE_OPTIONS"])
 
     db.init_app(app)
+    engine_profile.init_app(app)
     mail.init_app(app)
+    outbox.init_app(app)
     login_manager.init_app(app)
+    llm_gateway.init_app(app)
+    response_cache.init_app(app)
+    task_queue.init_app(app)
+    query_counter.init_app(app)
+    metrics.init_app(app)
+    cache.init_app(app)
     app.register_blueprint(app_routes)
 
-    with app.app_context():
-        from models import User, Chat, Message, Attachment
-        db.create_all()
-
-        engine = db.engine  # ✅ fixed deprecation
-        with engine.connect() as conn:
-            try:
-                res = conn.execute(text("PRAGMA table_info('attachment')")).fetchall()
-                cols = [row[1] for row in res]
-                if "message_id" not in cols:
-                    print("⚠️ 'message_id' missing in 'attachment'. Adding column...")
-                    conn.execute(text("ALTER TABLE attachment ADD COLUMN message_id INTEGER"))
-                    print("✅ Column added.")
-            except Exception as e:
-                print(f"⚠️ Schema check failed: {e}")
+    # Schema changes run once per release (`flask db-upgrade`), not on every worker boot
+    @app.cli.command("db-upgrade")
+    def db_upgrade():
+        """Create missing tables and apply pending schema migrations."""
+        version = migrations.upgrade_database(db)
+        print(f"✅ Database schema at v{version}")
 
     return app
 
@@ -35,4 +37,6 @@ def create_app():
 app = create_app()
 
 if __name__ == "__main__":
+    with app.app_context():
+        migrations.upgrade_database(db)  # dev server convenience; deployments run `flask db-upgrade`
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,111 @@
+# benchmarks/bench_chat_queries.py
+"""
+Chat page query times on a seeded SQLite database, before and after the hot-path indexes.
+
+    python benchmarks/bench_chat_queries.py --chats 100000 --messages 10000000 --db /tmp/mirai_bench.db
+
+The defaults are that scale: seeding 10M messages takes several minutes and ~2 GB of disk
+(pass smaller --chats/--messages for a quick run). An existing --db file is reused (seeding is
+skipped) so runs can be repeated; the sizes reported are the ones found in it.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import migrations  # noqa: E402
+from extensions import db  # noqa: E402
+import models  # noqa: E402,F401  (registers tables on db.metadata)
+
+INDEXES = ["ix_chat_user_id_created_at", "ix_message_chat_id_timestamp", "ix_message_chat_id_id",
+           "ix_attachment_user_id", "ix_attachment_chat_id", "ix_attachment_message_id"]
+
+QUERIES = {
+    "sidebar (chats by user)": "SELECT id, name, created_at FROM chat WHERE user_id = :user ORDER BY created_at DESC",
+    "chat page (messages by chat)": "SELECT id, content, sender, timestamp FROM message WHERE chat_id = :chat ORDER BY timestamp",
+    "history (last 40 by chat)": "SELECT id, content, sender FROM message WHERE chat_id = :chat AND id > 0 ORDER BY id DESC LIMIT 40",
+    "attachments by chat": "SELECT id FROM attachment WHERE chat_id = :chat",
+}
+
+
+def seed(engine, chats, messages, users):
+    db.metadata.create_all(engine)
+    per_chat = max(1, messages // chats)
+    start = datetime(2024, 1, 1)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO user (id, email, password_hash, username, is_confirmed) VALUES (:id, :e, 'x', :u, 1)"),
+                     [{"id": u, "e": f"user{u}@gmail.com", "u": f"user{u}"} for u in range(1, users + 1)])
+    msg_id = 0
+    chat_batch, batch = [], []
+    for chat in range(1, chats + 1):
+        chat_batch.append({"id": chat, "t": start + timedelta(minutes=chat), "u": random.randint(1, users)})
+        for n in range(per_chat):
+            msg_id += 1
+            batch.append({"id": msg_id, "c": "lorem ipsum " * 8, "s": "user" if n % 2 == 0 else "assistant",
+                          "t": start + timedelta(minutes=chat, seconds=n), "chat": chat})
+        if len(batch) >= 50000 or chat == chats:  # one transaction per batch, not per chat
+            print(f"  seeding chat {chat}/{chats}", end="\r", flush=True)
+            with engine.begin() as conn:
+                conn.execute(text("INSERT INTO chat (id, name, created_at, user_id) VALUES (:id, 'Chat', :t, :u)"),
+                             chat_batch)
+                conn.execute(text("INSERT INTO message (id, content, sender, timestamp, chat_id) VALUES (:id, :c, :s, :t, :chat)"), batch)
+            chat_batch, batch = [], []
+    print()
+
+
+def time_queries(engine, chats, users, samples):
+    results = {}
+    with engine.connect() as conn:
+        for label, sql in QUERIES.items():
+            timings = []
+            for _ in range(samples):
+                params = {"user": random.randint(1, users), "chat": random.randint(1, chats)}
+                started = time.perf_counter()
+                conn.execute(text(sql), params).fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            results[label] = (statistics.median(timings), timings[int(len(timings) * 0.95) - 1])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=10000000)
+    parser.add_argument("--db", default="/tmp/mirai_bench.db")
+    parser.add_argument("--samples", type=int, default=50)
+    args = parser.parse_args()
+    engine = create_engine(f"sqlite:///{args.db}")
+    if not os.path.exists(args.db) or os.path.getsize(args.db) == 0:
+        print(f"Seeding {args.chats} chats / {args.messages} messages ...")
+        seed(engine, args.chats, args.messages, max(1, args.chats // 20))
+    with engine.connect() as conn:  # a reused --db may have been seeded at another scale
+        chats, messages, users = (conn.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+                                  for table in ("chat", "message", "user"))
+    print(f"{chats} chats / {messages} messages / {users} users")
+
+    with engine.begin() as conn:
+        for name in INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        conn.execute(text("DROP TABLE IF EXISTS schema_version"))
+    before = time_queries(engine, chats, users, args.samples)
+
+    migrations.upgrade(engine)
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+    after = time_queries(engine, chats, users, args.samples)
+
+    print(f"{'query':<32} {'before p50/p95 ms':>20} {'after p50/p95 ms':>20}")
+    for label in QUERIES:
+        b, a = before[label], after[label]
+        print(f"{label:<32} {b[0]:>9.2f}/{b[1]:<10.2f} {a[0]:>9.2f}/{a[1]:<10.2f}")
+
+
+if __name__ == "__main__":
+    main()
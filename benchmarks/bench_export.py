@@ -0,0 +1,77 @@
+# benchmarks/bench_export.py
+"""
+Peak Python memory while streaming /export for growing histories (should stay flat).
+
+    python benchmarks/bench_export.py --sizes 10000 100000 300000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+tmp = tempfile.mkdtemp()
+os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp}/export.db"
+os.environ.setdefault("SECRET_KEY", "bench")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sqlalchemy import text  # noqa: E402
+import app as app_module  # noqa: E402
+import migrations  # noqa: E402
+from extensions import db  # noqa: E402
+from models import User  # noqa: E402
+
+app = app_module.app
+with app.app_context():
+    migrations.upgrade_database(db)
+
+
+def seed(user_id, start_id, count):
+    rows = [{"id": start_id + n, "c": "lorem ipsum dolor sit amet " * 10, "s": "user" if n % 2 == 0 else "assistant",
+             "t": datetime(2024, 1, 1), "chat": user_id} for n in range(count)]
+    db.session.execute(text("INSERT INTO message (id, content, sender, timestamp, chat_id) VALUES (:id, :c, :s, :t, :chat)"), rows)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 200000])
+    parser.add_argument("--format", default="jsonl")
+    args = parser.parse_args()
+
+    with app.app_context():
+        user = User(email="bench@gmail.com", username="bench", is_confirmed=True)
+        user.set_password("bench")
+        db.session.add(user)
+        db.session.commit()
+        db.session.execute(text("INSERT INTO chat (id, name, user_id) VALUES (:id, 'Bench', :id)"), {"id": user.id})
+        db.session.commit()
+        user_id = user.id
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(user_id)
+        sess["_fresh"] = True
+
+    seeded = 0
+    print(f"{'messages':>10} {'bytes':>12} {'seconds':>8} {'peak MB':>8}")
+    for size in args.sizes:
+        with app.app_context():
+            seed(user_id, seeded + 1, size - seeded)
+        seeded = size
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        resp = client.get(f"/export?format={args.format}", buffered=False)
+        total = sum(len(chunk) for chunk in resp.response)
+        resp.close()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+        print(f"{size:>10} {total:>12} {elapsed:>8.2f} {peak:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# benchmarks/bench_file_serving.py
+"""
+/files/<id> throughput per serving mode: full body through Python, Range request,
+If-None-Match revalidation (304) and X-Accel-Redirect hand-off (headers only).
+
+    python benchmarks/bench_file_serving.py --sizes 200000 5000000 --seconds 3
+
+Runs the WSGI app in-process (test client), so the numbers are worker time per request
+without network or proxy; the X-Accel row is what a worker still does once nginx sends the bytes.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+tmp = tempfile.mkdtemp()
+os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp}/files.db"
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ["TASK_BACKEND"] = "sync"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as app_module  # noqa: E402
+import migrations  # noqa: E402
+from extensions import db  # noqa: E402
+from models import User  # noqa: E402
+
+app = app_module.app
+app.instance_path = tmp
+with app.app_context():
+    migrations.upgrade_database(db)
+
+
+def rate(client, url, seconds, **kwargs):
+    """(requests/s, body bytes/s, status) for back-to-back GETs during `seconds`."""
+    count, body, status = 0, 0, None
+    deadline = time.perf_counter() + seconds
+    started = time.perf_counter()
+    while time.perf_counter() < deadline:
+        resp = client.get(url, **kwargs)
+        body += len(resp.data)
+        status = resp.status_code
+        count += 1
+    elapsed = time.perf_counter() - started
+    return count / elapsed, body / elapsed, status
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200_000, 5_000_000])
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    with app.app_context():
+        user = User(email="bench@gmail.com", username="bench", is_confirmed=True)
+        user.set_password("bench")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(user_id)
+        sess["_fresh"] = True
+
+    print(f"{'size':>10} {'mode':<16} {'status':>6} {'req/s':>9} {'MB/s':>9}")
+    for size in args.sizes:
+        resp = client.post("/upload_file/0", data={"file": (io.BytesIO(os.urandom(size)), "bench.bin")},
+                           content_type="multipart/form-data")
+        url = resp.get_json()["file"]["url"]
+        etag = client.get(url).headers["ETag"]
+
+        modes = [
+            ("full body", {}),
+            ("range 64 KB", {"headers": {"Range": "bytes=0-65535"}}),
+            ("revalidate", {"headers": {"If-None-Match": etag}}),
+        ]
+        for label, kwargs in modes:
+            per_sec, bytes_per_sec, status = rate(client, url, args.seconds, **kwargs)
+            print(f"{size:>10} {label:<16} {status:>6} {per_sec:>9.0f} {bytes_per_sec / 1e6:>9.1f}")
+
+        app.config["X_ACCEL_REDIRECT_PREFIX"] = "/_blobs"
+        per_sec, _, status = rate(client, url, args.seconds)
+        app.config["X_ACCEL_REDIRECT_PREFIX"] = None
+        print(f"{size:>10} {'x-accel-redirect':<16} {status:>6} {per_sec:>9.0f} {'-':>9}")
+
+
+if __name__ == "__main__":
+    main()
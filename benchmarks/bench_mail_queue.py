@@ -0,0 +1,125 @@
+# benchmarks/bench_mail_queue.py
+"""
+/register latency with the outbound mail queue, against a local stand-in SMTP server that
+is slow to greet (like a remote server's connect + TLS handshake), and how the background
+sender delivers the backlog: messages sent vs SMTP connections opened.
+
+    python benchmarks/bench_mail_queue.py --users 50 --greeting-delay 0.3
+
+--fail-first N makes the server answer 451 (try again later) to the first N messages,
+to watch the retries.
+"""
+import argparse
+import os
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+tmp = tempfile.mkdtemp()
+os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp}/mail.db"
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ["MAIL_USE_TLS"] = "False"
+os.environ["MAIL_USERNAME"] = "mirai@gmail.com"
+os.environ["MAIL_RETRY_BACKOFF"] = "0.2"
+os.environ["MAIL_POLL_INTERVAL"] = "0.2"
+
+
+class StandInSMTP(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: greeting, EHLO, MAIL, RCPT, DATA, RSET, NOOP, QUIT."""
+    greeting_delay = 0.0
+    fail_first = 0
+    connections = 0
+    messages = 0
+    lock = threading.Lock()
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        cls = type(self)
+        with cls.lock:
+            cls.connections += 1
+        time.sleep(cls.greeting_delay)
+        self.reply("220 stand-in ESMTP")
+        for raw in self.rfile:
+            command = raw.decode(errors="replace").strip().upper()
+            if command.startswith("EHLO"):
+                self.reply("250-stand-in")
+                self.reply("250 8BITMIME")
+            elif command.startswith(("HELO", "MAIL", "RCPT", "RSET", "NOOP")):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                for line in self.rfile:
+                    if line in (b".\r\n", b".\n"):
+                        break
+                with cls.lock:
+                    cls.messages += 1
+                    refuse = cls.messages <= cls.fail_first
+                self.reply("451 Try again later" if refuse else "250 Queued")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--greeting-delay", type=float, default=0.3)
+    parser.add_argument("--fail-first", type=int, default=0)
+    args = parser.parse_args()
+
+    StandInSMTP.greeting_delay = args.greeting_delay
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), StandInSMTP)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["MAIL_SERVER"], os.environ["MAIL_PORT"] = "127.0.0.1", str(server.server_address[1])
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as app_module
+    import migrations
+    from extensions import db, mail, outbox
+    from flask_mail import Message
+
+    app = app_module.app
+    with app.app_context():
+        migrations.upgrade_database(db)
+    app.config["WTF_CSRF_ENABLED"] = False
+    client = app.test_client()
+
+    with app.test_request_context():
+        started = time.perf_counter()
+        mail.send(Message("direct", sender="mirai@gmail.com", recipients=["x@gmail.com"], body="hi"))
+        direct = (time.perf_counter() - started) * 1000
+    StandInSMTP.messages, StandInSMTP.fail_first = 0, args.fail_first
+    connections_before = StandInSMTP.connections
+
+    timings = []
+    for n in range(args.users):
+        started = time.perf_counter()
+        resp = client.post("/register", data={"email": f"user{n}@gmail.com", "password": "secret1",
+                                              "confirm_password": "secret1"})
+        timings.append((time.perf_counter() - started) * 1000)
+        assert resp.status_code == 302, resp.status_code
+    print(f"direct mail.send:          {direct:8.1f} ms")
+    print(f"/register p50 (queued):    {statistics.median(timings):8.1f} ms  (mostly password hashing)")
+
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        with app.app_context():
+            depth = outbox.depth()
+        if not depth.get("queued"):
+            break
+        time.sleep(0.1)
+    print(f"queue after drain:         {depth}")
+    print(f"delivered {outbox.sent} messages over {StandInSMTP.connections - connections_before} SMTP connection(s); "
+          f"{outbox.retried} retries, {outbox.failed} given up")
+
+
+if __name__ == "__main__":
+    main()
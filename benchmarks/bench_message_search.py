@@ -0,0 +1,108 @@
+# benchmarks/bench_message_search.py
+"""
+/search query latency (search.search_messages) on a seeded SQLite database.
+
+    python benchmarks/bench_message_search.py --messages 2000000 --db /tmp/mirai_search.db
+    python benchmarks/bench_message_search.py --users 4 --db /tmp/mirai_search_heavy.db   # 250k messages per user
+
+Messages are random sentences over a Zipf-distributed vocabulary, spread over --users users
+with 50 chats each; the FTS index is maintained by the v6 triggers while seeding. An existing
+--db file is reused. The LIKE scan (fallback path, unranked) is timed for comparison; it only
+reads the searching user's messages, so it degrades with heavy users rather than total size.
+"""
+import argparse
+import itertools
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+from flask import Flask
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import migrations  # noqa: E402
+import search  # noqa: E402
+from extensions import db  # noqa: E402
+import models  # noqa: E402,F401
+
+VOCAB = [f"w{n}" for n in range(20000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCAB))))
+CHATS_PER_USER = 50
+
+
+def sentence(rng):
+    return " ".join(rng.choices(VOCAB, cum_weights=CUM_WEIGHTS, k=rng.randint(8, 30)))
+
+
+def seed(messages, users):
+    rng = random.Random(7)
+    db.session.execute(text("INSERT INTO user (id, email, password_hash, username, is_confirmed) VALUES (:id, :e, 'x', :u, 1)"),
+                       [{"id": u, "e": f"user{u}@gmail.com", "u": f"user{u}"} for u in range(1, users + 1)])
+    db.session.execute(text("INSERT INTO chat (id, name, created_at, user_id) VALUES (:id, 'Chat', :t, :u)"),
+                       [{"id": c, "t": datetime(2024, 1, 1), "u": (c - 1) // CHATS_PER_USER + 1}
+                        for c in range(1, users * CHATS_PER_USER + 1)])
+    batch = []
+    for n in range(1, messages + 1):
+        batch.append({"id": n, "c": sentence(rng), "s": "user" if n % 2 else "assistant",
+                      "t": datetime(2024, 1, 1), "chat": rng.randint(1, users * CHATS_PER_USER)})
+        if len(batch) == 50000 or n == messages:
+            db.session.execute(text("INSERT INTO message (id, content, sender, timestamp, chat_id) "
+                                    "VALUES (:id, :c, :s, :t, :chat)"), batch)
+            db.session.commit()
+            batch = []
+            print(f"  seeded {n}/{messages}", end="\r", flush=True)
+    print()
+
+
+def timed(fn, samples):
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[max(0, int(len(timings) * 0.95) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--db", default="/tmp/mirai_search.db")
+    parser.add_argument("--samples", type=int, default=30)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{args.db}"
+    db.init_app(app)
+    with app.app_context():
+        fresh = not os.path.exists(args.db) or os.path.getsize(args.db) == 0
+        db.create_all()
+        migrations.upgrade(db.engine)
+        if fresh:
+            print(f"Seeding {args.messages} messages for {args.users} users ...")
+            seed(args.messages, args.users)
+
+        queries = {
+            "common word": "w1",
+            "mid-frequency word": "w250",
+            "rare word": "w15000",
+            "two words": "w3 w40",
+            "prefix (typing)": "w123",
+        }
+        user = lambda: random.randint(1, args.users)  # noqa: E731
+
+        print(f"{'query':<22} {'fts p50/p95 ms':>18} {'like p50/p95 ms':>18}")
+        for label, q in queries.items():
+            fts = timed(lambda: search.search_messages(user(), q, limit=20), args.samples)
+            search._fts_tables[str(db.engine.url)] = False
+            like = timed(lambda: search.search_messages(user(), q, limit=20), max(3, args.samples // 10))
+            search._fts_tables[str(db.engine.url)] = True
+            print(f"{label:<22} {fts[0]:>8.2f}/{fts[1]:<9.2f} {like[0]:>8.2f}/{like[1]:<9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# benchmarks/bench_pdf_extraction.py
+"""
+Full-document vs page-bounded PDF extraction on synthetic PDFs.
+
+    python benchmarks/bench_pdf_extraction.py [pages ...]
+"""
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+import PyPDF2
+from PyPDF2 import PageObject
+from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from extraction import ATTACHMENT_PROMPT_CHARS, extract_pdf_text  # noqa: E402
+
+
+def make_pdf(pages, lines_per_page=40):
+    writer = PyPDF2.PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+    for n in range(pages):
+        page = PageObject.create_blank_page(width=612, height=792)
+        body = "".join(f"BT /F1 10 Tf 40 {760 - i * 18} Td (Page {n} line {i}: lorem ipsum dolor sit amet) Tj ET\n"
+                       for i in range(lines_per_page))
+        stream = DecodedStreamObject()
+        stream.set_data(body.encode())
+        page[NameObject("/Contents")] = writer._add_object(stream)
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})
+        })
+        writer.add_page(page)
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+def full_extract(data, max_chars):
+    reader = PyPDF2.PdfReader(io.BytesIO(data))
+    return " ".join((page.extract_text() or "") for page in reader.pages)[:max_chars], len(reader.pages)
+
+
+def measure(fn, data):
+    tracemalloc.start()
+    started = time.perf_counter()
+    text, pages = fn(data)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return text, pages, elapsed, peak
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10, 100, 500]
+    print(f"{'pages':>6} {'mode':>8} {'pages read':>10} {'ms':>9} {'peak KiB':>9}")
+    for pages in sizes:
+        data = make_pdf(pages)
+        full = measure(lambda d: full_extract(d, ATTACHMENT_PROMPT_CHARS), data)
+        lazy = measure(lambda d: extract_pdf_text(io.BytesIO(d), ATTACHMENT_PROMPT_CHARS)[:2], data)
+        assert full[0] == lazy[0], "lazy extraction must return the same prefix"
+        for mode, (_, read, elapsed, peak) in (("full", full), ("bounded", lazy)):
+            print(f"{pages:>6} {mode:>8} {read:>10} {elapsed * 1000:>9.1f} {peak / 1024:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# benchmarks/bench_sqlite_load.py
+"""
+Concurrent mixed load on one SQLite file, the way several gunicorn workers share it:
+--workers processes x --threads threads, each thread a logged-in user who mostly reads
+(/jarvis, /chats/<id>/messages) and sometimes writes (/send_message, model call stubbed).
+Each engine profile runs on its own copy of the same seeded database.
+
+    python benchmarks/bench_sqlite_load.py --workers 4 --threads 8 --seconds 10
+
+Profiles: SQLite defaults (rollback journal, synchronous=FULL), the tuned EngineProfile
+(WAL, synchronous=NORMAL, busy_timeout, mmap, cache), and tuned + the read-only pool.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULTS = {"SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "", "SQLITE_BUSY_TIMEOUT_MS": "",
+            "SQLITE_MMAP_SIZE": "", "SQLITE_CACHE_SIZE_KB": ""}
+PROFILES = {
+    "sqlite defaults": DEFAULTS,
+    "tuned": {},
+    "tuned + read pool": {"READ_POOL": "1"},
+}
+COMMON = {"SECRET_KEY": "bench", "TASK_BACKEND": "sync", "SUMMARY_THRESHOLD": "1000000000"}
+
+
+def seed(db_path, users, messages):
+    os.environ.update(COMMON, SQLALCHEMY_DATABASE_URI=f"sqlite:///{db_path}", **DEFAULTS)
+    sys.path.insert(0, ROOT)
+    import app as app_module
+    import migrations
+    from sqlalchemy import text
+    from extensions import db
+
+    with app_module.app.app_context():
+        migrations.upgrade_database(db)
+        db.session.execute(text("INSERT INTO user (id, email, password_hash, username, is_confirmed) "
+                                "VALUES (:id, :e, 'x', :u, 1)"),
+                           [{"id": u, "e": f"user{u}@gmail.com", "u": f"user{u}"} for u in range(1, users + 1)])
+        db.session.execute(text("INSERT INTO chat (id, name, user_id) VALUES (:id, 'Bench', :id)"),
+                           [{"id": u} for u in range(1, users + 1)])
+        db.session.execute(text("INSERT INTO message (content, sender, timestamp, chat_id) VALUES (:c, :s, :t, :chat)"),
+                           [{"c": "lorem ipsum dolor sit amet " * 8, "s": "user" if n % 2 else "assistant",
+                             "t": datetime(2024, 1, 1), "chat": n % users + 1} for n in range(messages)])
+        db.session.commit()
+
+
+def worker(first_user, threads, seconds, write_ratio):
+    """Child process: print one JSON line of per-request samples."""
+    sys.path.insert(0, ROOT)
+    import app as app_module
+    import routes
+
+    app = app_module.app
+    routes.generate_response = lambda *args, **kwargs: "ok"  # no network; only the database is measured
+    samples, lock = [], threading.Lock()
+
+    def run(user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["_user_id"] = str(user_id)
+            sess["_fresh"] = True
+        rng = random.Random(user_id)
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            write = rng.random() < write_ratio
+            started = time.perf_counter()
+            try:
+                if write:
+                    status = client.post(f"/send_message/{user_id}", json={"message": "hello"}).status_code
+                elif rng.random() < 0.5:
+                    status = client.get(f"/jarvis?chat_id={user_id}").status_code
+                else:
+                    status = client.get(f"/chats/{user_id}/messages?limit=50").status_code
+            except Exception:  # e.g. "database is locked" raised past the error handlers
+                status = 500
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                samples.append(("write" if write else "read", status, elapsed))
+
+    pool = [threading.Thread(target=run, args=(first_user + n,)) for n in range(threads)]
+    [t.start() for t in pool]
+    [t.join() for t in pool]
+    print(json.dumps(samples))
+
+
+def run_profile(db_path, env_overrides, args):
+    env = dict(os.environ, **COMMON, SQLALCHEMY_DATABASE_URI=f"sqlite:///{db_path}")
+    env.update({k: v for k, v in env_overrides.items() if k != "READ_POOL"})
+    if env_overrides.get("READ_POOL"):
+        env["SQLALCHEMY_READ_URI"] = env["SQLALCHEMY_DATABASE_URI"]
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker",
+                               str(1 + w * args.threads), str(args.threads), str(args.seconds), str(args.write_ratio)],
+                              cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+             for w in range(args.workers)]
+    samples = []
+    for proc in procs:
+        out, _ = proc.communicate()
+        samples.extend(json.loads(out.strip().splitlines()[-1]))
+    return samples
+
+
+def percentiles(values):
+    if not values:
+        return "-"
+    values = sorted(values)
+    return f"{statistics.median(values):7.1f}/{values[max(0, int(len(values) * 0.95) - 1)]:<7.1f}"
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        first_user, threads, seconds, write_ratio = sys.argv[2:6]
+        worker(int(first_user), int(threads), float(seconds), float(write_ratio))
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--messages", type=int, default=50000)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    template = os.path.join(tmp, "template.db")
+    seed(template, args.workers * args.threads, args.messages)
+
+    print(f"{args.workers} workers x {args.threads} threads, {args.seconds:.0f}s, {args.write_ratio:.0%} writes")
+    print(f"{'profile':<20} {'req/s':>7} {'errors':>7} {'read p50/p95 ms':>17} {'write p50/p95 ms':>17}")
+    for label, overrides in PROFILES.items():
+        db_path = os.path.join(tmp, f"{label.replace(' ', '_')}.db")
+        shutil.copy(template, db_path)
+        samples = run_profile(db_path, overrides, args)
+        errors = sum(1 for _, status, _ in samples if status >= 500)
+        reads = [ms for kind, status, ms in samples if kind == "read" and status < 500]
+        writes = [ms for kind, status, ms in samples if kind == "write" and status < 500]
+        print(f"{label:<20} {len(samples) / args.seconds:>7.0f} {errors:>7} {percentiles(reads):>17} {percentiles(writes):>17}")
+
+
+if __name__ == "__main__":
+    main()
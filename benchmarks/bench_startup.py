@@ -0,0 +1,53 @@
+# benchmarks/bench_startup.py
+"""
+Worker boot time: `import app` (what gunicorn does per worker) in fresh interpreters,
+against an already migrated database, plus the slowest top-level imports.
+
+    python benchmarks/bench_startup.py --runs 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROBE = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ, SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp}/startup.db", SECRET_KEY="bench")
+    subprocess.run([sys.executable, "-m", "flask", "--app", "app", "db-upgrade"], cwd=ROOT, env=env,
+                   check=True, capture_output=True)
+
+    timings = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, env=env, check=True,
+                             capture_output=True, text=True)
+        timings.append(float(out.stdout.strip().splitlines()[-1]) * 1000)
+    print(f"import app: median {statistics.median(timings):.0f} ms, min {min(timings):.0f} ms ({args.runs} runs)")
+
+    # -X importtime: "import time: self [us] | cumulative | imported package"
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=ROOT, env=env,
+                         check=True, capture_output=True, text=True)
+    top_level = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit() and name.startswith("   ") and not name.startswith("     "):
+            top_level.append((int(cumulative) / 1000, name.strip()))  # modules imported by app.py itself
+    print(f"\nslowest imports under app (cumulative ms):")
+    for ms, name in sorted(top_level, reverse=True)[:args.top]:
+        print(f"  {ms:8.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# benchmarks/check_query_counts.py
+"""
+N+1 guard: SQL statements per request must not grow with the number of messages or attachments.
+
+    python benchmarks/check_query_counts.py
+
+Runs against a throwaway SQLite database with the model call stubbed out, reads the
+X-SQL-Statements header (instrumentation.QueryCounter) and exits non-zero if a page
+issues more statements for a bigger chat than for a small one.
+"""
+import io
+import os
+import sys
+import tempfile
+
+tmp = tempfile.mkdtemp()
+os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp}/counts.db"
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ["SQL_COUNT_HEADER"] = "True"
+os.environ["TASK_BACKEND"] = "sync"
+os.environ["CACHE_BACKEND"] = "memory"
+os.environ["CACHE_PER_PROCESS"] = "True"  # one process, so the per-process cache is safe
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as app_module  # noqa: E402
+import migrations  # noqa: E402
+import routes  # noqa: E402
+from extensions import db  # noqa: E402
+from models import User, Chat, Message, Attachment  # noqa: E402
+
+app = app_module.app
+app.instance_path = tmp
+with app.app_context():
+    migrations.upgrade_database(db)
+routes.generate_response = lambda *args, **kwargs: "ok"  # no network; we only count SQL
+
+
+def seed_chat(user_id, messages, attachments_per_message):
+    chat = Chat(name="Bench", user_id=user_id)
+    db.session.add(chat)
+    db.session.flush()
+    for n in range(messages):
+        msg = Message(content=f"message {n}", sender="user" if n % 2 == 0 else "assistant", chat_id=chat.id)
+        db.session.add(msg)
+        db.session.flush()
+        for k in range(attachments_per_message):
+            db.session.add(Attachment(filename=f"f{k}.txt", path=f"missing-{n}-{k}.txt", content_type="text/plain",
+                                      user_id=user_id, chat_id=chat.id, message_id=msg.id))
+    db.session.commit()
+    return chat.id
+
+
+def statements(client, method, url, **kwargs):
+    resp = getattr(client, method)(url, **kwargs)
+    assert resp.status_code < 400, (url, resp.status_code)
+    return int(resp.headers["X-SQL-Statements"])
+
+
+def upload(client, chat_id, count):
+    ids = []
+    for k in range(count):
+        resp = client.post(f"/upload_file/{chat_id}", data={"file": (io.BytesIO(b"notes"), f"n{k}.txt")},
+                           content_type="multipart/form-data")
+        ids.append(resp.get_json()["file"]["id"])
+    return [{"id": i} for i in ids]
+
+
+def main():
+    with app.app_context():
+        user = User(email="bench@gmail.com", username="bench", is_confirmed=True)
+        user.set_password("bench")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        small = seed_chat(user_id, 10, 2)
+        large = seed_chat(user_id, 200, 2)
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(user_id)
+        sess["_fresh"] = True
+
+    client.get("/jarvis")  # warm the user/sidebar cache so both sides measure the steady state
+    checks = [
+        ("chat page", statements(client, "get", f"/jarvis?chat_id={small}"),
+         statements(client, "get", f"/jarvis?chat_id={large}")),
+        ("history page", statements(client, "get", f"/chats/{small}/messages?limit=200"),
+         statements(client, "get", f"/chats/{large}/messages?limit=200")),
+        ("send_message", statements(client, "post", f"/send_message/{small}",
+                                    json={"message": "hi", "attachments": upload(client, small, 1)}),
+         statements(client, "post", f"/send_message/{small}",
+                    json={"message": "hi", "attachments": upload(client, small, 8)})),
+    ]
+
+    failed = False
+    print(f"{'request':<16} {'small':>6} {'large':>6}")
+    for label, few, many in checks:
+        flag = "" if many <= few else "  <-- grows with size (N+1?)"
+        failed = failed or bool(flag)
+        print(f"{label:<16} {few:>6} {many:>6}{flag}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
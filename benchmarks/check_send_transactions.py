@@ -0,0 +1,133 @@
+# benchmarks/check_send_transactions.py
+"""
+Guard for short write transactions: /send_message (blocking and streaming), /upload_chat and
+the background title job must not have a database connection checked out while the model
+call runs, and another writer must be able to commit meanwhile (on SQLite a held connection
+can mean a held write lock, so every other request's INSERT waits for the LLM).
+
+    python benchmarks/check_send_transactions.py
+
+The upstream call is stubbed; the stub records instrumentation.QueryCounter.connections_held()
+for the calling thread and tries a write from a second thread. Exits non-zero on a violation.
+"""
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+
+tmp = tempfile.mkdtemp()
+os.environ["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp}/transactions.db"
+os.environ.setdefault("SECRET_KEY", "bench")
+os.environ["TASK_BACKEND"] = "sync"
+os.environ["RESPONSE_CACHE_ENABLED"] = "False"
+os.environ["SQLITE_BUSY_TIMEOUT_MS"] = "200"  # a held write lock shows up as "database is locked"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as app_module  # noqa: E402
+import migrations  # noqa: E402
+import utils  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from extensions import db, query_counter  # noqa: E402
+from models import User, Chat  # noqa: E402
+
+app = app_module.app
+app.instance_path = tmp
+with app.app_context():
+    migrations.upgrade_database(db)
+calls = []
+
+
+def concurrent_write():
+    """Commit a write from another thread while the model call is in flight; returns an error or None."""
+    outcome = []
+
+    def write():
+        with app.app_context():
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(text("UPDATE user SET username = username"))
+                outcome.append(None)
+            except Exception as e:
+                outcome.append(str(getattr(e, "orig", e)))  # the DB-API error, without SQLAlchemy's footer
+
+    worker = threading.Thread(target=write)
+    worker.start()
+    worker.join()
+    return outcome[0]
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+
+    def json(self):
+        return {"choices": [{"message": {"content": self.text}}]}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self, decode_unicode=False):
+        for word in self.text.split(" "):
+            yield "data: " + json.dumps({"choices": [{"delta": {"content": word + " "}}]})
+        yield "data: [DONE]"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def stub_completion(payload, timeout=None, stream=False):
+    calls.append((query_counter.connections_held(), concurrent_write()))
+    return StubResponse("stubbed reply from the model")
+
+
+utils.chat_completion = stub_completion  # what generate_response / stream_response call
+
+
+def run(label, client, method, url, **kwargs):
+    start = len(calls)
+    resp = getattr(client, method)(url, **kwargs)
+    resp.get_data()  # drain a streamed body: the upstream call happens while it is consumed
+    assert resp.status_code < 400, (label, resp.status_code)
+    return [(label, held, error) for held, error in calls[start:]]
+
+
+def main():
+    with app.app_context():
+        user = User(email="bench@gmail.com", username="bench", is_confirmed=True)
+        user.set_password("bench")
+        db.session.add(user)
+        db.session.flush()
+        chats = [Chat(name="New Chat", user_id=user.id) for _ in range(2)]
+        db.session.add_all(chats)
+        db.session.commit()
+        user_id, blocking, streaming = user.id, chats[0].id, chats[1].id
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["_user_id"] = str(user_id)
+        sess["_fresh"] = True
+
+    results = []
+    results += run("send_message", client, "post", f"/send_message/{blocking}", json={"message": "hi"})
+    results += run("send_message (stream)", client, "post", f"/send_message/{streaming}",
+                   json={"message": "hi", "stream": True})
+    results += run("upload_chat", client, "post", "/upload_chat",
+                   data={"file": (io.BytesIO(b"notes"), "notes.txt"), "prompt": "summarize"},
+                   content_type="multipart/form-data")
+
+    failed = not results
+    print(f"{'upstream call during':<24} {'held':>4}  concurrent write")
+    for label, held, error in results:
+        failed = failed or held > 0 or error is not None
+        print(f"{label:<24} {held:>4}  {error or 'ok'}")
+    print(f"{len(results)} upstream calls (replies and background titles)")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# benchmarks/stage_report.py
+"""
+Which stage dominates an endpoint's latency: reads mirai_stage_seconds from a worker's
+/metrics (instrumentation.Metrics) and prints per-stage count, share of time, and p50/p95/p99
+estimated from the histogram buckets.
+
+    python benchmarks/stage_report.py http://localhost:5000/metrics --endpoint app_routes.send_message
+
+The worker needs METRICS_ENABLED=True; pass --token when METRICS_TOKEN is set. Numbers are per worker process.
+"""
+import argparse
+import re
+from collections import defaultdict
+
+import requests
+
+SAMPLE = re.compile(r'^mirai_stage_seconds_(bucket|sum|count)\{(.*)\} (\S+)$')
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+
+def quantile(buckets, q):
+    """Linear interpolation inside the bucket holding the q-th observation (as Prometheus does)."""
+    buckets = sorted(buckets)
+    total = buckets[-1][1]
+    if not total:
+        return 0.0
+    rank, lower, below = q * total, 0.0, 0
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            if bound == float("inf"):
+                return lower  # above the largest finite bucket
+            return lower + (bound - lower) * (rank - below) / max(cumulative - below, 1)
+        lower, below = bound, cumulative
+    return lower
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--endpoint", default="app_routes.send_message")
+    parser.add_argument("--token")
+    args = parser.parse_args()
+
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+    resp = requests.get(args.url, headers=headers, timeout=10)
+    resp.raise_for_status()
+
+    buckets, sums, counts = defaultdict(list), {}, {}
+    for line in resp.text.splitlines():
+        match = SAMPLE.match(line)
+        if not match:
+            continue
+        kind, label_text, value = match.groups()
+        labels = dict(LABEL.findall(label_text))
+        if labels.get("endpoint") != args.endpoint:
+            continue
+        stage = labels["stage"]
+        if kind == "bucket":
+            buckets[stage].append((float(labels["le"]), float(value)))
+        elif kind == "sum":
+            sums[stage] = float(value)
+        else:
+            counts[stage] = int(float(value))
+
+    if not counts:
+        print(f"no stage timings for {args.endpoint} yet")
+        return
+    # ttft (and ttft_cache / ttft_coalesced) is part of model
+    grand_total = sum(v for stage, v in sums.items() if not stage.startswith("ttft")) or 1.0
+    print(f"{args.endpoint}")
+    print(f"{'stage':<14} {'count':>7} {'share':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage in sorted(sums, key=sums.get, reverse=True):
+        p50, p95, p99 = (quantile(buckets[stage], q) * 1000 for q in (0.5, 0.95, 0.99))
+        print(f"{stage:<14} {counts[stage]:>7} {sums[stage] / grand_total:>6.0%} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# cache.py
+import json
+import threading
+import time
+from collections import OrderedDict
+from werkzeug.utils import import_string
+
+
+class MemoryBackend:
+    """Per-process LRU with a TTL (default). Other workers see a write after at most CACHE_TTL."""
+    shared = False
+
+    def __init__(self, app, ttl=None, max_entries=None):
+        self.max_entries = max_entries or app.config.get("CACHE_MAX_ENTRIES", 10000)
+        self.ttl = ttl or app.config.get("CACHE_TTL", 300)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class RedisBackend:
+    """Shared across workers/hosts; CACHE_REDIS_URL. Values must be JSON-serializable."""
+    shared = True
+
+    def __init__(self, app, ttl=None, max_entries=None):
+        import redis  # optional dependency, only needed for this backend
+        self.ttl = ttl or app.config.get("CACHE_TTL", 300)
+        self._client = redis.Redis.from_url(app.config.get("CACHE_REDIS_URL") or "redis://localhost:6379/0")
+
+    def get(self, key):
+        raw = self._client.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value):
+        self._client.set(key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self._client.delete(key)
+
+
+class NullBackend:
+    """Caching off: every lookup misses (Cache.enabled is False, so callers skip the cache)."""
+    shared = False
+
+    def __init__(self, app, ttl=None, max_entries=None):
+        pass
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+
+BACKENDS = {"memory": MemoryBackend, "redis": RedisBackend, "null": NullBackend}
+
+
+def make_backend(app, name, **options):
+    """Backend by name or import path ("pkg.module:Backend"); options: ttl, max_entries."""
+    backend_cls = BACKENDS.get(name) or import_string(name.replace(":", "."))
+    return backend_cls(app, **options)
+
+
+class Cache:
+    """
+    Read-through cache for small, hot, per-user data (the logged-in user row, the sidebar
+    chat list). Values are plain dicts/lists so any backend can hold them; writers call the
+    invalidate_* helpers after committing. CACHE_BACKEND picks "memory", "redis", "null", or an
+    import path ("pkg.module:Backend") to any class taking (app, ttl=None, max_entries=None)
+    and exposing get/set/delete (plus `shared = True` if every worker sees the same entries).
+    Invalidation only reaches the writer's own process, so a per-process backend is bypassed
+    unless CACHE_PER_PROCESS says there is a single worker. Check `enabled` to skip work that only
+    serves the cache.
+    """
+
+    def __init__(self, app=None):
+        self._backend = None
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.stats = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._backend = make_backend(app, app.config.get("CACHE_BACKEND", "null"))
+        self.enabled = not isinstance(self._backend, NullBackend) and (
+            getattr(self._backend, "shared", False) or app.config.get("CACHE_PER_PROCESS", False))
+        app.extensions["cache"] = self
+
+    def _count(self, namespace, outcome):
+        with self._lock:
+            counters = self.stats.setdefault(namespace, {"hits": 0, "misses": 0})
+            counters[outcome] += 1
+
+    def get_or_load(self, namespace, key, loader):
+        """Cached value for namespace:key, calling loader() on a miss. None results aren't cached."""
+        if not self.enabled:
+            return loader()
+        full_key = f"{namespace}:{key}"
+        value = self._backend.get(full_key)
+        if value is not None:
+            self._count(namespace, "hits")
+            return value
+        self._count(namespace, "misses")
+        value = loader()
+        if value is not None:
+            self._backend.set(full_key, value)
+        return value
+
+    def delete(self, namespace, key):
+        self._backend.delete(f"{namespace}:{key}")
+
+    def invalidate_user(self, user_id):
+        self.delete("user", user_id)
+
+    def invalidate_chats(self, user_id):
+        self.delete("chats", user_id)
@@ -12,6 +12,26 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.getenv("SQLALCHEMY_DATABASE_URI")
     SQLALCHEMY_TRACK_MODIFICATIONS = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS', 'False') == 'True'
 
+    # Connection pool per worker process (also used for the read engine); in-memory SQLite
+    # ignores the pool sizes (database.engine_options)
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": int(os.getenv('DB_POOL_SIZE', 10)),
+        "max_overflow": int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        "pool_timeout": float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        "pool_recycle": int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        "pool_pre_ping": os.getenv('DB_POOL_PRE_PING', 'True') == 'True',
+    }
+    # Optional second engine for read-heavy views (chat page, files, history, search, export);
+    # for SQLite use the same file, for other databases a replica
+    SQLALCHEMY_READ_URI = os.getenv('SQLALCHEMY_READ_URI')
+
+    # SQLite PRAGMAs applied to every new connection (database.EngineProfile); empty = SQLite default
+    SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT_MS = os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000')
+    SQLITE_MMAP_SIZE = os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))
+    SQLITE_CACHE_SIZE_KB = os.getenv('SQLITE_CACHE_SIZE_KB', '20000')   # page cache per connection
+
     # Mail Config
     MAIL_SERVER = os.getenv('MAIL_SERVER')
     MAIL_PORT = int(os.getenv('MAIL_PORT', 587))
@@ -20,6 +40,17 @@ class Config:
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = os.getenv('MAIL_DEFAULT_SENDER')
 
+    # Outbound mail queue (outbound_email table): sent in batches over one kept-alive SMTP connection,
+    # failures retried after MAIL_RETRY_BACKOFF * 2^n seconds. MAIL_QUEUE_WORKER=False makes this
+    # process enqueue only (another process sends).
+    MAIL_QUEUE_WORKER = os.getenv('MAIL_QUEUE_WORKER', 'True') == 'True'
+    MAIL_BATCH_SIZE = int(os.getenv('MAIL_BATCH_SIZE', 50))
+    MAIL_MAX_ATTEMPTS = int(os.getenv('MAIL_MAX_ATTEMPTS', 6))
+    MAIL_RETRY_BACKOFF = float(os.getenv('MAIL_RETRY_BACKOFF', 30))
+    MAIL_POLL_INTERVAL = float(os.getenv('MAIL_POLL_INTERVAL', 5))     # also picks up other workers' messages
+    MAIL_IDLE_TIMEOUT = float(os.getenv('MAIL_IDLE_TIMEOUT', 60))      # close the SMTP connection after this idle
+    MAIL_SEND_LEASE = int(os.getenv('MAIL_SEND_LEASE', 300))           # a claimed batch is retried if not done by then
+
     # Uploads (path only; creation happens when app is available)
     UPLOAD_FOLDER = os.path.join(BASE_DIR, 'instance', 'uploads')
 
@@ -27,5 +58,104 @@ class Config:
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB per request (tune as needed)
     ALLOWED_EXTENSIONS = {'png','jpg','jpeg','gif','pdf','txt','doc','docx'}
 
+    # Upload storage: content-addressed blobs (sha256, sharded ab/cd/<hash>) shared by identical uploads.
+    # Files above CHUNKED_UPLOAD_THRESHOLD go through resumable /uploads sessions in UPLOAD_CHUNK_BYTES
+    # pieces, so MAX_CONTENT_LENGTH caps a request (chunk), and MAX_UPLOAD_BYTES a file.
+    BLOB_STORAGE_DIR = os.getenv('BLOB_STORAGE_DIR')                          # default instance/blobs
+    MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 512 * 1024 * 1024))
+    UPLOAD_CHUNK_BYTES = int(os.getenv('UPLOAD_CHUNK_BYTES', 8 * 1024 * 1024))
+    CHUNKED_UPLOAD_THRESHOLD = int(os.getenv('CHUNKED_UPLOAD_THRESHOLD', 8 * 1024 * 1024))
+    UPLOAD_SESSION_TTL = int(os.getenv('UPLOAD_SESSION_TTL', 86400))          # abandoned sessions are removed after this
+    BLOB_GC_GRACE = int(os.getenv('BLOB_GC_GRACE', 3600))                     # unreferenced blobs kept this long (s)
+
+    # File serving (/files/<id>): browser cache lifetime for immutable blobs, and optional hand-off of
+    # the byte transfer to a front proxy -- nginx (internal location aliased to the blob directory,
+    # e.g. X_ACCEL_REDIRECT_PREFIX=/_blobs) or Apache/lighttpd X-Sendfile
+    FILE_CACHE_MAX_AGE = int(os.getenv('FILE_CACHE_MAX_AGE', 31536000))
+    X_ACCEL_REDIRECT_PREFIX = os.getenv('X_ACCEL_REDIRECT_PREFIX')
+    USE_X_SENDFILE = os.getenv('USE_X_SENDFILE', 'False') == 'True'
+
+    # Extracted attachment text, keyed by content hash (defaults to instance/extract_cache)
+    EXTRACTION_CACHE_DIR = os.getenv('EXTRACTION_CACHE_DIR')
+    # Swept at most every EXTRACTION_CACHE_SWEEP_INTERVAL seconds (and by the blob GC): entries of older
+    # extractor versions or unused for EXTRACTION_CACHE_MAX_AGE go, then least recently used above MAX_BYTES
+    EXTRACTION_CACHE_MAX_BYTES = int(os.getenv('EXTRACTION_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+    EXTRACTION_CACHE_MAX_AGE = int(os.getenv('EXTRACTION_CACHE_MAX_AGE', 30 * 86400))
+    EXTRACTION_CACHE_SWEEP_INTERVAL = int(os.getenv('EXTRACTION_CACHE_SWEEP_INTERVAL', 3600))
+    EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', 2))            # processes for PDF/DOCX/OCR at upload
+    EXTRACTION_TIMEOUT = float(os.getenv('EXTRACTION_TIMEOUT', 120))        # give up on one file after this
+    EXTRACTION_WAIT_SECONDS = float(os.getenv('EXTRACTION_WAIT_SECONDS', 3))  # send_message waits this long for pending files
+    PDF_SAMPLE_PAGES = int(os.getenv('PDF_SAMPLE_PAGES', 0)) or None      # read only the first N pages (+ outline); None = until max_chars
+
     # OpenRouter
     OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
+    OPENROUTER_API_URL = os.getenv('OPENROUTER_API_URL', 'https://openrouter.ai/api/v1/chat/completions')
+    # kept-alive connections per worker; defaults to (and is never below) LLM_MAX_CONCURRENCY
+    OPENROUTER_POOL_SIZE = int(os.getenv('OPENROUTER_POOL_SIZE', 0))
+    OPENROUTER_CONNECT_TIMEOUT = float(os.getenv('OPENROUTER_CONNECT_TIMEOUT', 5))
+    OPENROUTER_READ_TIMEOUT = float(os.getenv('OPENROUTER_READ_TIMEOUT', 30))
+    OPENROUTER_TITLE_TIMEOUT = float(os.getenv('OPENROUTER_TITLE_TIMEOUT', 15))
+    OPENROUTER_MAX_RETRIES = int(os.getenv('OPENROUTER_MAX_RETRIES', 2))           # connect errors + 429/5xx only
+    OPENROUTER_RETRY_BACKOFF = float(os.getenv('OPENROUTER_RETRY_BACKOFF', 0.5))   # exponential backoff factor (s)
+    OPENROUTER_RETRY_JITTER = float(os.getenv('OPENROUTER_RETRY_JITTER', 0.5))     # random extra delay (s)
+
+    # Prompt size cap (estimated tokens) for system prompt + history + current turn
+    CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 3000))
+
+    # Rolling summary: once memory holds more than SUMMARY_THRESHOLD messages, all but the
+    # newest SUMMARY_KEEP_RECENT are folded into Chat.summary by a background task
+    SUMMARY_THRESHOLD = int(os.getenv('SUMMARY_THRESHOLD', 16))
+    SUMMARY_KEEP_RECENT = int(os.getenv('SUMMARY_KEEP_RECENT', 6))
+    MEMORY_MAX_MESSAGES = int(os.getenv('MEMORY_MAX_MESSAGES', 40))   # hard cap if summarizing falls behind
+
+    # Chat page history: messages per page (initial render and /chats/<id>/messages)
+    MESSAGE_PAGE_SIZE = int(os.getenv('MESSAGE_PAGE_SIZE', 50))
+    MESSAGE_PAGE_MAX = int(os.getenv('MESSAGE_PAGE_MAX', 200))
+
+    # Message search (/search): results per page; matches ranked per query (newest first)
+    SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+    SEARCH_RANK_WINDOW = int(os.getenv('SEARCH_RANK_WINDOW', 2000))
+
+    # Exports (/export, /chats/<id>/export): messages fetched per batch from the DB cursor
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 500))
+
+    # LLM gateway (admission control for model calls)
+    LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 100))   # in-flight calls per process
+    LLM_MAX_PER_USER = int(os.getenv('LLM_MAX_PER_USER', 2))           # in-flight calls per user
+    LLM_MAX_BACKGROUND = int(os.getenv('LLM_MAX_BACKGROUND', 4))       # in-flight summaries/titles (not per user)
+    LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', 5))       # seconds to wait for a slot before 503
+
+    # Cache for the logged-in user and sidebar chat list: "redis", "memory" (per process), "null",
+    # or "pkg.module:Backend"; defaults to "redis" when CACHE_REDIS_URL (or REDIS_URL) is set, else off.
+    # A write only invalidates the writing worker's "memory" copy, so that backend is bypassed
+    # unless CACHE_PER_PROCESS=True (one worker process).
+    CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL') or os.getenv('REDIS_URL')
+    CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'redis' if CACHE_REDIS_URL else 'null')
+    CACHE_PER_PROCESS = os.getenv('CACHE_PER_PROCESS', 'False') == 'True'
+    CACHE_TTL = int(os.getenv('CACHE_TTL', 300))
+    CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 10000))
+
+    # SQL statements per request: X-SQL-Statements header, and a log warning above the budget (0 = off)
+    SQL_COUNT_HEADER = os.getenv('SQL_COUNT_HEADER', 'False') == 'True'
+    SQL_STATEMENT_BUDGET = int(os.getenv('SQL_STATEMENT_BUDGET', 0))
+    # Log a warning when a model call starts while its thread still has a DB connection checked out
+    SQL_CONNECTION_GUARD = os.getenv('SQL_CONNECTION_GUARD', 'True') == 'True'
+
+    # Per-stage request timings: Server-Timing response header, and Prometheus text on /metrics
+    # (per worker process). /metrics is off by default; METRICS_TOKEN, when set, requires
+    # "Authorization: Bearer <token>". Without a token it is public, so only enable it behind a
+    # proxy that keeps it internal.
+    SERVER_TIMING_HEADER = os.getenv('SERVER_TIMING_HEADER', 'True') == 'True'
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'False') == 'True'
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+    # Reuse of chat replies: identical retries/double submits within the TTL get the stored reply,
+    # and concurrent identical requests share one upstream call. Off by default.
+    RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'False') == 'True'
+    RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'memory')
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 600))
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 1000))
+
+    # Background tasks (chat titling, ...): "thread", "sync" or "pkg.module:Backend"
+    TASK_BACKEND = os.getenv('TASK_BACKEND', 'thread')
+    TASK_WORKERS = int(os.getenv('TASK_WORKERS', 4))
@@ -0,0 +1,64 @@
+# context.py -- token-budgeted prompt assembly for chat calls
+import re
+
+# Blocks appended to user turns by send_message (see routes.send_message)
+ATTACHMENTS_BLOCK = re.compile(r"--- Attachments ---\n.*?\n--- End attachments ---", re.S)
+ATTACHMENT_STUB_CHARS = 200   # what survives of an older turn's attachment block
+MESSAGE_OVERHEAD_TOKENS = 4   # role/separator tokens per chat message
+
+
+def estimate_tokens(text):
+    """Fast local estimate (~4 characters per token for English/Llama-style BPE); no tokenizer download."""
+    return (len(text or "") + 3) // 4
+
+
+def message_tokens(message):
+    return MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message.get("content"))
+
+
+def condense_attachments(content):
+    """Replace attachment blocks with a short excerpt."""
+    def stub(match):
+        body = match.group(0)[len("--- Attachments ---\n"):-len("\n--- End attachments ---")].strip()
+        excerpt = body[:ATTACHMENT_STUB_CHARS] + ("…" if len(body) > ATTACHMENT_STUB_CHARS else "")
+        return f"[Earlier attachments, excerpt: {excerpt}]"
+    return ATTACHMENTS_BLOCK.sub(stub, content)
+
+
+def build_context(system_messages, history, user_turn, budget):
+    """
+    Assemble [system..., history..., user_turn] under `budget` estimated tokens.
+    Shedding order:
+      1. attachment blocks in older turns are condensed to an excerpt (oldest first),
+      2. oldest history turns are dropped,
+      3. the current turn itself is truncated as a last resort.
+    System messages and the current turn are always sent.
+    Returns (messages, prompt_tokens).
+    """
+    history = [dict(m) for m in history]
+    fixed = sum(message_tokens(m) for m in system_messages) + message_tokens(user_turn)
+    sizes = [message_tokens(m) for m in history]
+    total = fixed + sum(sizes)
+
+    for i, message in enumerate(history):
+        if total <= budget:
+            break
+        if "--- Attachments ---" in (message.get("content") or ""):
+            message["content"] = condense_attachments(message["content"])
+            new_size = message_tokens(message)
+            total -= sizes[i] - new_size
+            sizes[i] = new_size
+
+    start = 0
+    while total > budget and start < len(history):
+        total -= sizes[start]
+        start += 1
+    history = history[start:]
+
+    if total > budget:
+        system_tokens = fixed - message_tokens(user_turn)
+        room = max(0, budget - system_tokens - MESSAGE_OVERHEAD_TOKENS)
+        user_turn = dict(user_turn, content=user_turn["content"][:room * 4])
+        total = system_tokens + message_tokens(user_turn)
+
+    return list(system_messages) + history + [user_turn], total
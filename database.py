@@ -0,0 +1,101 @@
+# database.py -- engine setup: SQLite PRAGMAs per connection, optional read-only engine for read-heavy views
+import functools
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+# create_engine arguments only a QueuePool accepts; in-memory SQLite gets a StaticPool instead
+QUEUE_POOL_OPTIONS = ("pool_size", "max_overflow", "pool_timeout")
+
+
+def engine_options(uri, options):
+    """SQLALCHEMY_ENGINE_OPTIONS fitted to uri: an in-memory SQLite database lives on one shared
+    connection (StaticPool), which rejects pool sizes, so those are left out for it."""
+    if not uri:
+        return dict(options)
+    url = make_url(uri)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {key: value for key, value in options.items() if key not in QUEUE_POOL_OPTIONS}
+    return dict(options)
+
+
+class RoutingSession(Session):
+    """db.session class: inside @read_only views, reads go to the read engine (if configured).
+    Flushes always use the primary, so a view may still write."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get("db_read_only"):
+            engine = current_app.extensions.get("db_read_engine")
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_only(view):
+    """Serve this view's queries from the read engine (SQLALCHEMY_READ_URI); no-op without one.
+    Only for views that never write based on what they read: a replica may lag behind."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+class EngineProfile:
+    """
+    Per-connection tuning for SQLite, the deployed store. Every new connection gets:
+      journal_mode (WAL: readers never block the writer and vice versa), synchronous
+      (NORMAL is durable across app crashes in WAL mode; the last commits may roll back on
+      power loss), busy_timeout (wait for the write lock instead of "database is locked"),
+      mmap_size and cache_size (page reads from memory). An empty setting leaves SQLite's default.
+    SQLALCHEMY_READ_URI adds a second engine with its own pool for @read_only views; for SQLite
+    point it at the same file (its connections are opened query_only), elsewhere at a replica.
+    Pool sizes for both come from SQLALCHEMY_ENGINE_OPTIONS.
+    """
+
+    def __init__(self, app=None):
+        self.read_engine = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._config = app.config
+        db = app.extensions["sqlalchemy"]
+        with app.app_context():
+            for engine in db.engines.values():
+                self._tune(engine)
+
+        read_uri = app.config.get("SQLALCHEMY_READ_URI")
+        if read_uri:
+            options = engine_options(read_uri, app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+            self.read_engine = create_engine(read_uri, **options)
+            self._tune(self.read_engine, query_only=True)
+            app.extensions["db_read_engine"] = self.read_engine
+        app.extensions["engine_profile"] = self
+
+    def pragmas(self):
+        config = self._config
+        cache_kb = config.get("SQLITE_CACHE_SIZE_KB")
+        settings = [
+            ("journal_mode", config.get("SQLITE_JOURNAL_MODE")),
+            ("synchronous", config.get("SQLITE_SYNCHRONOUS")),
+            ("busy_timeout", config.get("SQLITE_BUSY_TIMEOUT_MS")),
+            ("mmap_size", config.get("SQLITE_MMAP_SIZE")),
+            ("cache_size", -int(cache_kb) if cache_kb else None),  # negative = KiB rather than pages
+        ]
+        return [(name, value) for name, value in settings if value not in (None, "")]
+
+    def _tune(self, engine, query_only=False):
+        if engine.dialect.name != "sqlite":
+            return
+        statements = [f"PRAGMA {name}={value}" for name, value in self.pragmas()]
+        if query_only:
+            statements.append("PRAGMA query_only=ON")
+
+        @event.listens_for(engine, "connect")
+        def _on_connect(dbapi_conn, connection_record):
+            cursor = dbapi_conn.cursor()
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.close()
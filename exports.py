@@ -0,0 +1,170 @@
+# exports.py -- streamed chat exports (JSONL / Markdown / JSON / plain text), optionally gzipped on the fly
+import json
+import zlib
+from datetime import datetime
+from flask import url_for
+from sqlalchemy import select
+from extensions import db
+from models import Chat, Message, Attachment
+
+FORMATS = {
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "md": ("text/markdown; charset=utf-8", "md"),
+    "json": ("application/json", "json"),
+    "txt": ("text/plain; charset=utf-8", "txt"),
+}
+GZIP_CHUNK_BYTES = 64 * 1024
+
+
+def _iso(value):
+    return value.isoformat() if value else None
+
+
+def _chat_record(chat):
+    return {"id": chat.id, "name": chat.name, "created_at": _iso(chat.created_at)}
+
+
+def _message_record(m, attachments):
+    return {
+        "id": m.id,
+        "chat_id": m.chat_id,
+        "sender": m.sender,
+        "timestamp": _iso(m.timestamp),
+        "content": m.content,
+        "attachments": [{
+            "id": a.id,
+            "filename": a.filename,
+            "content_type": a.content_type,
+            "sha256": a.content_hash,
+            "url": url_for("app_routes.serve_file", file_id=a.id, _external=True),
+        } for a in attachments],
+    }
+
+
+def _message_batches(user_id, chat_id, batch_size):
+    """
+    Yield lists of (message row, attachment rows) in (chat_id, id) order. Plain column rows
+    come off a server-side cursor batch by batch (yield_per), and each batch's attachments are
+    fetched with one IN query, so memory is bounded by batch_size rather than by history size.
+    """
+    stmt = (select(Message.id, Message.chat_id, Message.sender, Message.timestamp, Message.content)
+            .join(Chat, Chat.id == Message.chat_id)
+            .where(Chat.user_id == user_id))
+    if chat_id is not None:
+        stmt = stmt.where(Message.chat_id == chat_id)
+    stmt = stmt.order_by(Message.chat_id, Message.id).execution_options(yield_per=batch_size)
+
+    for partition in db.session.execute(stmt).partitions():
+        by_message = {}
+        ids = [m.id for m in partition]
+        attachments = db.session.execute(
+            select(Attachment.id, Attachment.message_id, Attachment.filename, Attachment.content_type,
+                   Attachment.content_hash)
+            .where(Attachment.message_id.in_(ids)))
+        for att in attachments:
+            by_message.setdefault(att.message_id, []).append(att)
+        yield [(m, by_message.get(m.id, [])) for m in partition]
+
+
+def _export_records(user_id, chat_id, batch_size):
+    """("chat", record) / ("message", record) events; a chat's messages follow its header."""
+    query = Chat.query.filter_by(user_id=user_id)
+    if chat_id is not None:
+        query = query.filter_by(id=chat_id)
+    chats = {c.id: _chat_record(c) for c in query.order_by(Chat.id)}
+
+    pending = sorted(chats)  # chats without messages are exported too
+    for batch in _message_batches(user_id, chat_id, batch_size):
+        for m, attachments in batch:
+            while pending and pending[0] <= m.chat_id:
+                yield "chat", chats[pending.pop(0)]
+            yield "message", _message_record(m, attachments)
+        yield "flush", None
+    for cid in pending:
+        yield "chat", chats[cid]
+
+
+def _jsonl(events):
+    lines = []
+    for kind, record in events:
+        if kind == "flush":
+            yield "".join(lines)
+            lines = []
+            continue
+        lines.append(json.dumps({"type": kind, **record}, ensure_ascii=False) + "\n")
+    yield "".join(lines)
+
+
+def _markdown(events):
+    parts = []
+    for kind, record in events:
+        if kind == "flush":
+            yield "".join(parts)
+            parts = []
+        elif kind == "chat":
+            parts.append(f"# {record['name'] or 'Chat'}\n\n_Created {record['created_at'] or ''}_\n\n")
+        else:
+            who = "🧑 You" if record["sender"] == "user" else "🤖 Mirai"
+            parts.append(f"**{who}** · {record['timestamp'] or ''}\n\n{record['content']}\n\n")
+            for a in record["attachments"]:
+                parts.append(f"- 📎 [{a['filename']}]({a['url']})\n")
+            if record["attachments"]:
+                parts.append("\n")
+    yield "".join(parts)
+
+
+def _text(events):
+    """Plain text, as the old in-page export wrote it: message text, then its attachment names."""
+    parts = []
+    for kind, record in events:
+        if kind == "flush":
+            yield "".join(parts)
+            parts = []
+        elif kind == "chat":
+            parts.append(f"=== {record['name'] or 'Chat'} ===\n\n")
+        else:
+            who = "You" if record["sender"] == "user" else "Mirai"
+            parts.append(f"{who}: {record['content']}\n")
+            if record["attachments"]:
+                parts.append("Attachments: " + ", ".join(a["filename"] for a in record["attachments"]) + "\n")
+            parts.append("\n")
+    yield "".join(parts)
+
+
+def _json(events):
+    """One JSON document, written incrementally: {"exported_at": ..., "chats": [{..., "messages": [...]}]}."""
+    parts = [f'{{"exported_at": {json.dumps(_iso(datetime.utcnow()))}, "chats": [']
+    first_chat, first_message = True, True
+    for kind, record in events:
+        if kind == "flush":
+            yield "".join(parts)
+            parts = []
+        elif kind == "chat":
+            header = json.dumps(record, ensure_ascii=False)[:-1] + ', "messages": ['
+            parts.append(("" if first_chat else "]}, ") + header)
+            first_chat, first_message = False, True
+        else:
+            parts.append(("" if first_message else ", ") + json.dumps(record, ensure_ascii=False))
+            first_message = False
+    parts.append("]}\n" if first_chat else "]}]}\n")
+    yield "".join(parts)
+
+
+RENDERERS = {"jsonl": _jsonl, "md": _markdown, "json": _json, "txt": _text}
+
+
+def export_chunks(user_id, fmt, chat_id=None, batch_size=500):
+    """Text chunks (one per batch of messages) of the user's history, or of one chat."""
+    yield from RENDERERS[fmt](_export_records(user_id, chat_id, batch_size))
+
+
+def gzip_chunks(chunks):
+    """Gzip a text stream on the fly, emitting ~64 KB compressed blocks."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    buffer = b""
+    for chunk in chunks:
+        buffer += compressor.compress(chunk.encode("utf-8"))
+        if len(buffer) >= GZIP_CHUNK_BYTES:
+            yield buffer
+            buffer = b""
+    yield buffer + compressor.flush()
@@ -2,8 +2,22 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_mail import Mail
 from flask_login import LoginManager
+from database import EngineProfile, RoutingSession
+from llm import LLMGateway, ResponseCache
+from tasks import TaskQueue
+from instrumentation import Metrics, QueryCounter
+from cache import Cache
+from mailer import Outbox
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+engine_profile = EngineProfile()
 mail = Mail()
+outbox = Outbox()
 login_manager = LoginManager()
+llm_gateway = LLMGateway()
+response_cache = ResponseCache()
+task_queue = TaskQueue()
+query_counter = QueryCounter()
+metrics = Metrics()
+cache = Cache()
 login_manager.login_view = 'app_routes.login'
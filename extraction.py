@@ -0,0 +1,503 @@
+# extraction.py -- attachment text extraction (PDF, DOCX, TXT, OCR) with a content-addressed cache
+import os
+import time
+import hashlib
+import tempfile
+import importlib.util
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+
+# Parsers (PyPDF2, python-docx, Pillow + pytesseract) are imported on first use: they are slow
+# to import and most requests, and every worker boot, never need them.
+# Optional OCR support is detected without importing.
+OCR_AVAILABLE = all(importlib.util.find_spec(name) for name in ("PIL", "pytesseract"))
+
+MAX_OCR_CHARS = 1000         # max chars extracted from images
+ATTACHMENT_PROMPT_CHARS = 4000  # budget per attachment block in a chat prompt
+
+# Bump whenever extractor output changes so stale cache entries are ignored
+EXTRACTOR_VERSION = 3
+
+# OCR pipeline bounds
+OCR_MAX_PIXELS = 60_000_000   # refuse to decode more than this, after JPEG draft scaling (memory / bomb guard)
+OCR_TARGET_DPI = 300          # scans above this resolution are downscaled to it
+OCR_MAX_WIDTH = 2480          # ~A4 width at 300 DPI; wider photos are downscaled
+OCR_TILE_HEIGHT = 3508        # ~A4 height at 300 DPI; taller images are OCR'd strip by strip
+OCR_TILE_OVERLAP = 200        # strips overlap by a couple of text lines so none is cut in half
+OCR_THRESHOLD = None          # binarization cut-off after autocontrast; None = Otsu's per image
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".tif", ".webp", ".gif")
+
+CACHE_STATS = {"hits": 0, "misses": 0}
+CACHE_SIZE = {"bytes": 0, "entries": 0, "swept_at": None}  # as found by the last prune_cache
+OCR_STAGE_STATS = {}          # stage -> [count, total seconds]
+PDF_STATS = {"documents": 0, "sampled": 0, "pages_read": 0}  # sampled: PDF_SAMPLE_PAGES cut the text short
+
+
+def detect_kind(filename, ctype):
+    """Classify a file as 'text', 'pdf', 'docx', 'image' or None (unsupported)."""
+    name = (filename or "").lower()
+    ctype = (ctype or "").lower()
+    if name.endswith(".txt") or ctype.startswith("text"):
+        return "text"
+    if name.endswith(".pdf") or ctype == "application/pdf":
+        return "pdf"
+    if name.endswith(".docx") or ctype == DOCX_MIME:
+        return "docx"
+    if name.endswith(IMAGE_EXTS) or ctype.startswith("image"):
+        return "image"
+    return None
+
+
+def sha256_of(fileobj, chunk_size=1024 * 1024):
+    """Hex SHA-256 of a binary file object, read in chunks from its current position."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract_pdf_text(source, max_chars, sample_pages=None):
+    """
+    Pull PDF text page by page and stop as soon as max_chars is covered, so a
+    500-page file costs as much as its first few pages.
+    sample_pages: read at most the first N pages, prefixed by the document
+    outline (table of contents) when it has one.
+    Returns (text, pages_processed, page_count).
+    """
+    import PyPDF2
+
+    reader = PyPDF2.PdfReader(source)
+    parts, size, processed = [], 0, 0
+
+    if sample_pages:
+        toc = _pdf_outline_titles(reader)
+        if toc:
+            parts.append("Contents: " + "; ".join(toc))
+            size += len(parts[0]) + 1
+
+    pages = reader.pages if not sample_pages else (reader.pages[i] for i in range(min(sample_pages, len(reader.pages))))
+    for page in pages:
+        if size >= max_chars:
+            break
+        text = page.extract_text() or ""
+        processed += 1
+        parts.append(text)
+        size += len(text) + 1  # + the joining space
+    return " ".join(parts)[:max_chars], processed, len(reader.pages)
+
+
+def _pdf_outline_titles(reader, limit=50):
+    titles = []
+
+    def walk(items):
+        for item in items:
+            if len(titles) >= limit:
+                return
+            if isinstance(item, list):
+                walk(item)
+            elif getattr(item, "title", None):
+                titles.append(item.title)
+    try:
+        walk(reader.outline)
+    except Exception:
+        pass  # a broken outline shouldn't block text extraction
+    return titles
+
+
+def _variant(kind, pdf_sample_pages=None):
+    """Cache-key tag for the extractor configuration."""
+    return f"pdf-first{pdf_sample_pages}" if kind == "pdf" and pdf_sample_pages else kind
+
+
+def _extract(source, kind, max_chars, pdf_sample_pages=None, timings=None, pages=None):
+    """Extract text from a path or binary file object. Raises if the file can't be parsed.
+    timings: optional dict that receives per-stage OCR seconds.
+    pages: optional dict that receives a PDF's {"read": pages processed, "total": page count}."""
+    if kind == "pdf":
+        text, read, total = extract_pdf_text(source, max_chars, pdf_sample_pages)
+        if pages is not None:
+            pages.update(read=read, total=total, sampled=bool(pdf_sample_pages) and read < total)
+        return text
+    if kind == "docx":
+        import docx
+
+        doc = docx.Document(source)
+        text = "\n".join(para.text for para in doc.paragraphs)
+        return text[:max_chars]
+    if kind == "image":
+        text, stage_timings = ocr_image(source, max_chars)
+        if timings is not None:
+            timings.update(stage_timings)
+        return text
+    raise ValueError(f"no extractor for {kind!r}")
+
+
+# ---------------- OCR pipeline ----------------
+def _ocr_scale(img):
+    """Downscale factor: cap scans at OCR_TARGET_DPI and any image at OCR_MAX_WIDTH."""
+    scale = 1.0
+    dpi = (img.info.get("dpi") or (0, 0))[0] or 0
+    if dpi > OCR_TARGET_DPI:
+        scale = OCR_TARGET_DPI / float(dpi)
+    if img.width * scale > OCR_MAX_WIDTH:
+        scale = OCR_MAX_WIDTH / float(img.width)
+    return scale
+
+
+def ocr_image(source, max_chars):
+    """
+    Bounded OCR: decode at reduced size (JPEG draft mode), grayscale + binarize (Otsu's
+    threshold unless OCR_THRESHOLD is set), then OCR in overlapping horizontal strips until
+    max_chars is covered. OCR_MAX_PIXELS applies to the size actually decoded.
+    Returns (text, {stage: seconds}).
+    """
+    from PIL import Image, ImageOps
+    import pytesseract
+
+    timings = {}
+    mark = time.perf_counter()
+
+    def lap(stage):
+        nonlocal mark
+        now = time.perf_counter()
+        timings[stage] = timings.get(stage, 0.0) + now - mark
+        mark = now
+
+    with Image.open(source) as img:  # lazy: only the header is read here
+        scale = _ocr_scale(img)
+        target = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+        img.draft("L", target)  # JPEG decodes straight to grayscale at 1/2, 1/4 or 1/8 scale
+        if img.width * img.height > OCR_MAX_PIXELS:  # size after draft; other formats decode in full
+            raise ValueError(f"image too large for OCR ({img.width}x{img.height})")
+        gray = img.convert("L")
+    lap("decode")
+
+    if gray.size[0] > target[0]:
+        gray = gray.resize(target, Image.LANCZOS)
+    gray = ImageOps.autocontrast(gray)
+    threshold = OCR_THRESHOLD if OCR_THRESHOLD is not None else _otsu_threshold(gray.histogram())
+    binary = gray.point([255 if p >= threshold else 0 for p in range(256)])
+    del gray
+    lap("preprocess")
+
+    # Each line lies whole inside some strip; a strip keeps only the lines centred in its own
+    # band (its height minus half the overlap at each inner edge), which drops both the cut-off
+    # line at an edge and the copy of it read again by the neighbouring strip.
+    parts, size = [], 0
+    half = OCR_TILE_OVERLAP // 2
+    for top in range(0, binary.height, OCR_TILE_HEIGHT - OCR_TILE_OVERLAP):
+        if size >= max_chars:
+            break
+        bottom = min(top + OCR_TILE_HEIGHT, binary.height)
+        band = (top + half if top else 0, bottom - half if bottom < binary.height else bottom)
+        for center, text in _ocr_lines(pytesseract, binary.crop((0, top, binary.width, bottom))):
+            if band[0] <= top + center < band[1]:
+                parts.append(text)
+                size += len(text) + 1
+        if bottom == binary.height:
+            break
+    lap("ocr")
+
+    record_ocr_timings(timings)
+    return "\n".join(parts)[:max_chars], timings
+
+
+def _otsu_threshold(histogram):
+    """Cut-off that best separates a grayscale histogram into ink and paper (Otsu's method),
+    so faint or unevenly lit scans keep their text where a fixed 128 would wash it out."""
+    total = sum(histogram)
+    weighted_total = sum(level * count for level, count in enumerate(histogram))
+    best, best_variance = 128, -1.0
+    below = weighted_below = 0
+    for level, count in enumerate(histogram):
+        below += count
+        above = total - below
+        if not below:
+            continue
+        if not above:
+            break
+        weighted_below += level * count
+        gap = weighted_below / below - (weighted_total - weighted_below) / above
+        variance = below * above * gap * gap
+        if variance > best_variance:
+            best, best_variance = level + 1, variance
+    return best
+
+
+def _ocr_lines(pytesseract, tile):
+    """(vertical centre, text) of each line tesseract finds in a tile, in reading order."""
+    data = pytesseract.image_to_data(tile, output_type=pytesseract.Output.DICT)
+    lines = {}  # (block, paragraph, line) -> [top, bottom, words]
+    for i, word in enumerate(data["text"]):
+        if not word.strip():
+            continue
+        top, bottom = data["top"][i], data["top"][i] + data["height"][i]
+        line = lines.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), [top, bottom, []])
+        line[0], line[1] = min(line[0], top), max(line[1], bottom)
+        line[2].append(word)
+    return [((top + bottom) / 2, " ".join(words)) for top, bottom, words in lines.values()]
+
+
+def record_ocr_timings(timings):
+    for stage, seconds in timings.items():
+        entry = OCR_STAGE_STATS.setdefault(stage, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+
+def record_pdf_pages(pages, label):
+    """Count a PDF extraction; say so in the log when PDF_SAMPLE_PAGES left pages unread."""
+    PDF_STATS["documents"] += 1
+    PDF_STATS["pages_read"] += pages["read"]
+    if pages["sampled"]:
+        PDF_STATS["sampled"] += 1
+        current_app.logger.info("PDF %s sampled: read %s of %s pages (PDF_SAMPLE_PAGES)",
+                                label, pages["read"], pages["total"])
+
+
+# ---------------- extraction cache ----------------
+def cache_dir():
+    return current_app.config.get("EXTRACTION_CACHE_DIR") or os.path.join(current_app.instance_path, "extract_cache")
+
+
+def _cache_path(directory, digest, kind, max_chars):
+    # shard by hash prefix so the directory stays small
+    return os.path.join(directory, digest[:2], f"{digest}-{kind}-v{EXTRACTOR_VERSION}-{max_chars}.txt")
+
+
+def _cache_get(path):
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            text = fh.read()
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(path)  # mtime = last use, for prune_cache's LRU order
+    except OSError:
+        pass
+    return text
+
+
+def _cache_put(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as fh:
+        fh.write(text)
+    os.replace(tmp_path, path)  # atomic: concurrent readers never see a partial entry
+
+
+def cached_extract(digest, source, kind, max_chars):
+    """
+    Extract text once per (content hash, kind, extractor version, max_chars).
+    Identical files -- re-sent, re-uploaded, or uploaded by other users -- share one entry.
+    """
+    sample_pages = current_app.config.get("PDF_SAMPLE_PAGES")
+    path = _cache_path(cache_dir(), digest, _variant(kind, sample_pages), max_chars)
+    text = _cache_get(path)
+    if text is not None:
+        CACHE_STATS["hits"] += 1
+        return text
+
+    CACHE_STATS["misses"] += 1
+    pages = {}
+    text = _extract(source, kind, max_chars, sample_pages, pages=pages)
+    if pages:
+        record_pdf_pages(pages, digest[:12])
+    try:
+        _cache_put(path, text)
+    except OSError:
+        current_app.logger.warning("Could not write extraction cache entry %s", path)
+    return text
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def prune_cache(directory, max_bytes, max_age, digests=()):
+    """
+    Sweep the extraction cache: drop entries written by another EXTRACTOR_VERSION, entries of
+    `digests` (blobs the storage GC just deleted), entries unused for max_age seconds and stray
+    temp files, then the least recently used until the rest fits in max_bytes.
+    Returns the number of files removed; CACHE_SIZE keeps what is left.
+    """
+    now = time.time()
+    digests = set(digests)
+    version_tag = f"-v{EXTRACTOR_VERSION}-"
+    kept, removed = [], 0
+    for root, _dirs, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith(".tmp"):  # a _cache_put in progress, or one that crashed
+                if stat.st_mtime < now - 3600:
+                    removed += _remove(path)
+                continue
+            if (version_tag not in name or name.split("-", 1)[0] in digests
+                    or (max_age and stat.st_mtime < now - max_age)):
+                removed += _remove(path)
+            else:
+                kept.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _mtime, size, _path in kept)
+    entries = len(kept)
+    for _mtime, size, path in sorted(kept):
+        if not max_bytes or total <= max_bytes:
+            break
+        removed += _remove(path)
+        total -= size
+        entries -= 1
+    CACHE_SIZE.update(bytes=total, entries=entries, swept_at=now)
+    return removed
+
+
+def cache_sweep_due(interval):
+    """True when this process hasn't swept the extraction cache in the last `interval` seconds."""
+    swept_at = CACHE_SIZE["swept_at"]
+    return swept_at is None or swept_at < time.time() - interval
+
+
+# ---------------- eager extraction (process pool) ----------------
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def process_pool():
+    """
+    Worker processes for CPU-bound extraction (PDF parsing, OCR hold the GIL).
+    Spawned rather than forked so they don't inherit the web worker's threads or sockets.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=current_app.config.get("EXTRACTION_WORKERS", 2),
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return _process_pool
+
+
+def submit_extraction(*args):
+    """process_pool().submit(extract_file_to_cache, *args). A worker that died (e.g. OOM during OCR)
+    breaks the whole executor for good, so a broken pool is replaced and the submit retried once."""
+    global _process_pool
+    pool = process_pool()
+    try:
+        return pool.submit(extract_file_to_cache, *args)
+    except BrokenProcessPool:
+        with _process_pool_lock:
+            if _process_pool is pool:
+                _process_pool = None
+        pool.shutdown(wait=False)
+        return process_pool().submit(extract_file_to_cache, *args)
+
+
+def extract_file_to_cache(file_path, kind, max_chars, directory, pdf_sample_pages=None):
+    """Process-pool entry point: hash the file and fill the cache entry.
+    Returns (hex digest, per-stage OCR timings, PDF page counts) -- stats in the worker process
+    aren't visible to the app, so the caller records them."""
+    timings, pages = {}, {}
+    with open(file_path, "rb") as fh:
+        digest = sha256_of(fh)
+    path = _cache_path(directory, digest, _variant(kind, pdf_sample_pages), max_chars)
+    if _cache_get(path) is None:
+        _cache_put(path, _extract(file_path, kind, max_chars, pdf_sample_pages, timings, pages))
+    return digest, timings, pages
+
+
+def needs_extraction(filename, ctype):
+    """True when reading the file means parsing or OCR (worth doing ahead of time)."""
+    kind = detect_kind(filename, ctype)
+    return kind in ("pdf", "docx") or (kind == "image" and OCR_AVAILABLE)
+
+
+def read_stored_file_content(attachment, max_chars=MAX_OCR_CHARS):
+    """
+    Read a stored file (PDF, DOCX, TXT, or image) from server.
+    For images:
+        - Uses OCR if available.
+        - If OCR fails, returns a short description.
+    Returns a string to include in AI prompt.
+    """
+    from storage import attachment_path  # not at module level: spawned extraction workers import this module
+
+    stored_name = getattr(attachment, "path", None) or getattr(attachment, "stored_name", None)
+    if not stored_name:
+        return ""
+
+    file_path = attachment_path(attachment)
+    filename = getattr(attachment, "filename", stored_name)
+    kind = detect_kind(filename, getattr(attachment, "content_type", ""))
+
+    if not os.path.exists(file_path):
+        return f"[Attachment: {filename}] (file missing)"
+
+    try:
+        # TXT
+        if kind == "text":
+            with open(file_path, "r", encoding="utf-8", errors="ignore") as fh:
+                return fh.read(max_chars)
+
+        if kind is None:
+            return f"[Attachment: {filename}] (unsupported type)"
+
+        if kind == "image" and not OCR_AVAILABLE:
+            return _image_description(filename)
+
+        digest = getattr(attachment, "content_hash", None)
+        if not digest:
+            with open(file_path, "rb") as fh:
+                digest = sha256_of(fh)
+
+        try:
+            text = cached_extract(digest, file_path, kind, max_chars)
+        except Exception:
+            if kind == "image":
+                return _image_description(filename)
+            return f"[{kind.upper()}: {filename}] (unable to parse)"
+
+        if kind == "image" and not text:
+            return _image_description(filename)
+        return text
+
+    except Exception:
+        return f"[Attachment: {filename}] (unreadable)"
+
+
+def _image_description(filename):
+    return f"[Image: {filename}] Description: An image is attached. Possibly contains objects or scenes. AI should consider this in the response."
+
+
+def read_file_content(file_storage, max_chars=MAX_OCR_CHARS):
+    """Read uploaded FileStorage object (TXT, PDF, DOCX, Image)"""
+    kind = detect_kind(getattr(file_storage, "filename", ""), getattr(file_storage, "mimetype", ""))
+    try:
+        # TXT
+        if kind == "text":
+            file_storage.stream.seek(0)
+            text = file_storage.read().decode("utf-8", errors="ignore")
+            file_storage.stream.seek(0)
+            return text[:max_chars]
+
+        if kind is None or (kind == "image" and not OCR_AVAILABLE):
+            return "" if kind == "image" else None
+
+        stream = file_storage.stream
+        stream.seek(0)
+        digest = sha256_of(stream)
+        stream.seek(0)
+        text = cached_extract(digest, stream, kind, max_chars)
+        stream.seek(0)
+        return text
+    except Exception:
+        return "[Unreadable content]"
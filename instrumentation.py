@@ -0,0 +1,307 @@
+# instrumentation.py
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+
+class QueryCounter:
+    """
+    Counts SQL statements per request so N+1 patterns show up before they reach production.
+    - SQL_COUNT_HEADER: add X-SQL-Statements to every response.
+    - SQL_STATEMENT_BUDGET: log a warning when a request runs more statements (0 = off).
+    Statements issued outside a request (background tasks, CLI) are only counted in `total`.
+    Also tracks pooled connections checked out per thread: with SQL_CONNECTION_GUARD, a slow
+    upstream call (check_released) made while the thread still holds one logs a warning.
+    """
+
+    def __init__(self, app=None):
+        self.header = False
+        self.budget = 0
+        self.total = 0
+        self.over_budget = 0
+        self.guard = False
+        self.held_during_io = 0
+        self._held = {}
+        self._lock = threading.Lock()
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.header = app.config.get("SQL_COUNT_HEADER", self.header)
+        self.budget = app.config.get("SQL_STATEMENT_BUDGET", self.budget)
+        self.guard = app.config.get("SQL_CONNECTION_GUARD", self.guard)
+        if not self._listening:
+            event.listen(Engine, "before_cursor_execute", self._on_execute)
+            event.listen(Pool, "checkout", self._on_checkout)
+            event.listen(Pool, "checkin", self._on_checkin)
+            self._listening = True
+        app.after_request(self._after_request)
+        app.extensions["query_counter"] = self
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.total += 1
+        if has_request_context():
+            g.sql_statements = g.get("sql_statements", 0) + 1
+
+    def _on_checkout(self, dbapi_conn, connection_record, connection_proxy):
+        owner = threading.get_ident()
+        connection_record.info["checked_out_by"] = owner
+        with self._lock:
+            self._held[owner] = self._held.get(owner, 0) + 1
+
+    def _on_checkin(self, dbapi_conn, connection_record):
+        owner = connection_record.info.pop("checked_out_by", None)
+        if owner is None:
+            return
+        with self._lock:
+            left = self._held.get(owner, 0) - 1
+            if left > 0:
+                self._held[owner] = left
+            else:
+                self._held.pop(owner, None)
+
+    def connections_held(self):
+        """Pooled connections the current thread has checked out right now."""
+        return self._held.get(threading.get_ident(), 0)
+
+    def check_released(self, what):
+        """Call before slow I/O (a model call): holding a connection there pins it, and on
+        SQLite possibly the write lock, for the whole call."""
+        held = self.connections_held()
+        if held and self.guard:
+            with self._lock:
+                self.held_during_io += 1
+            current_app.logger.warning("%s started holding %s database connection(s)%s", what, held,
+                                       f" in {request.endpoint}" if has_request_context() else "")
+        return held
+
+    def _after_request(self, response):
+        count = self.count()
+        if self.header:
+            response.headers["X-SQL-Statements"] = str(count)
+        if self.budget and count > self.budget:
+            with self._lock:
+                self.over_budget += 1
+            current_app.logger.warning("SQL budget exceeded: %s statements (budget %s) for %s",
+                                       count, self.budget, request.endpoint)
+        return response
+
+    @staticmethod
+    def count():
+        """Statements run so far in the current request."""
+        return g.get("sql_statements", 0) if has_request_context() else 0
+
+
+# ---------------- latency metrics ----------------
+class Histogram:
+    """Prometheus-style cumulative histogram, one series per label set."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels (sorted tuple) -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self, name):
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        for key, counts, total, count in sorted(series):
+            for bound, n in zip(self.buckets, counts):
+                yield f"{name}_bucket", key + (("le", f"{bound:g}"),), n
+            yield f"{name}_bucket", key + (("le", "+Inf"),), count
+            yield f"{name}_sum", key, total
+            yield f"{name}_count", key, count
+
+
+class Metrics:
+    """
+    Where request time goes. Code wraps its phases in `metrics.stage(name)` (or reports a
+    duration measured by hand with `observe`); each stage lands in
+      - the Server-Timing response header (SERVER_TIMING_HEADER), next to the statement count
+        and the total, so browser devtools show the breakdown of a single request;
+      - mirai_stage_seconds{endpoint, stage} on /metrics (off unless METRICS_ENABLED; set
+        METRICS_TOKEN to require a bearer token), with request latency, SQL statements per request and the counters the
+        other extensions already keep (gateway, caches, task queue, outbox, extraction, OCR).
+    Streamed responses send their headers first: their Server-Timing covers the work before
+    the stream; the stages after it (ttft, model, commit) are only in /metrics. Streams answered
+    from the response cache time their first chunk as ttft_cache / ttft_coalesced instead of ttft.
+    Numbers are per worker process.
+    """
+    SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    STATEMENTS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+    def __init__(self, app=None):
+        self.header = True
+        self.token = None
+        self.stages = Histogram(self.SECONDS)
+        self.requests = Histogram(self.SECONDS)
+        self.statements = Histogram(self.STATEMENTS)
+        self.responses = {}  # (endpoint, method, status) -> count
+        self._lock = threading.Lock()
+        self._app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self.header = app.config.get("SERVER_TIMING_HEADER", self.header)
+        self.token = app.config.get("METRICS_TOKEN") or None
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        if app.config.get("METRICS_ENABLED", False):
+            if not self.token:
+                app.logger.warning("METRICS_ENABLED without METRICS_TOKEN: /metrics is readable by anyone")
+            app.add_url_rule("/metrics", "metrics", self._metrics_view)
+        app.extensions["metrics"] = self
+
+    # ---------------- recording ----------------
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as stage `name` of the current request (or background job)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def observe(self, name, seconds):
+        if has_request_context():
+            timings = g.setdefault("stage_timings", {})
+            timings[name] = timings.get(name, 0.0) + seconds  # repeated stages (per attachment) add up
+            endpoint = request.endpoint or "unmatched"
+        else:
+            endpoint = "background"
+        self.stages.observe(seconds, endpoint=endpoint, stage=name)
+
+    def _before_request(self):
+        g.request_started = time.perf_counter()
+
+    def _after_request(self, response):
+        started = g.get("request_started")
+        if started is None:
+            return response
+        endpoint, method, status = request.endpoint or "unmatched", request.method, response.status_code
+        statements = QueryCounter.count()
+        self.statements.observe(statements, endpoint=endpoint)
+        with self._lock:
+            key = (endpoint, method, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+        if self.header:
+            timings = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in g.get("stage_timings", {}).items()]
+            timings.append(f'sql;desc="{statements} statements"')
+            timings.append(f"total;dur={(time.perf_counter() - started) * 1000:.1f}")
+            response.headers["Server-Timing"] = ", ".join(timings)
+        # latency until the body is fully sent, which for a stream is when it ends
+        response.call_on_close(lambda: self.requests.observe(time.perf_counter() - started,
+                                                             endpoint=endpoint, method=method))
+        return response
+
+    # ---------------- exposition ----------------
+    def _metrics_view(self):
+        if self.token and request.headers.get("Authorization") != f"Bearer {self.token}":
+            abort(404)
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{sample_name}{{{label_text}}} {value}" if labels else f"{sample_name} {value}")
+
+        def scalar(name, kind, help_text, value):
+            family(name, kind, help_text, [(name, (), value)])
+
+        def labelled(name, kind, help_text, label, values):
+            family(name, kind, help_text, [(name, ((label, k),), v) for k, v in sorted(values.items())])
+
+        family("mirai_stage_seconds", "histogram", "Time spent per request stage.",
+               self.stages.samples("mirai_stage_seconds"))
+        family("mirai_request_seconds", "histogram", "Request latency until the response body is sent.",
+               self.requests.samples("mirai_request_seconds"))
+        family("mirai_request_sql_statements", "histogram", "SQL statements per request.",
+               self.statements.samples("mirai_request_sql_statements"))
+        with self._lock:
+            responses = sorted(self.responses.items())
+        family("mirai_responses_total", "counter", "Responses by endpoint, method and status.",
+               [("mirai_responses_total", (("endpoint", e), ("method", m), ("status", s)), n)
+                for (e, m, s), n in responses])
+
+        extensions = self._app.extensions
+        query_counter = extensions.get("query_counter")
+        if query_counter is not None:
+            scalar("mirai_sql_statements_total", "counter", "SQL statements executed.", query_counter.total)
+            scalar("mirai_sql_over_budget_total", "counter", "Requests over SQL_STATEMENT_BUDGET.",
+                   query_counter.over_budget)
+            scalar("mirai_sql_held_during_io_total", "counter", "Model calls started holding a DB connection.",
+                   query_counter.held_during_io)
+        sqlalchemy = extensions.get("sqlalchemy")
+        if sqlalchemy is not None:
+            with self._app.app_context():
+                engines = {"primary": sqlalchemy.engine, "read": extensions.get("db_read_engine")}
+            family("mirai_db_connections_checked_out", "gauge", "Pooled connections in use.",
+                   [("mirai_db_connections_checked_out", (("engine", name),), engine.pool.checkedout())
+                    for name, engine in engines.items() if engine is not None and hasattr(engine.pool, "checkedout")])
+        gateway = extensions.get("llm_gateway")
+        if gateway is not None:
+            scalar("mirai_llm_in_flight", "gauge", "Admitted model calls in progress.", gateway.in_flight)
+            scalar("mirai_llm_waiting", "gauge", "Model calls waiting for a gateway slot.", gateway.waiting)
+            scalar("mirai_llm_rejected_total", "counter", "Model calls refused by the gateway.", gateway.rejected)
+        response_cache = extensions.get("response_cache")
+        if response_cache is not None:
+            labelled("mirai_response_cache_total", "counter", "Chat reply lookups by outcome.", "outcome",
+                     {"hit": response_cache.hits, "coalesced": response_cache.coalesced,
+                      "miss": response_cache.misses})
+        cache = extensions.get("cache")
+        if cache is not None:
+            family("mirai_cache_total", "counter", "Read-through cache lookups by namespace and outcome.",
+                   [("mirai_cache_total", (("namespace", ns), ("outcome", outcome)), n)
+                    for ns, counters in sorted(cache.stats.items()) for outcome, n in sorted(counters.items())])
+        task_queue = extensions.get("task_queue")
+        if task_queue is not None:
+            scalar("mirai_tasks_pending", "gauge", "Background tasks queued or running.", task_queue.pending)
+            labelled("mirai_tasks_total", "counter", "Finished background tasks by outcome.", "outcome",
+                     {"completed": task_queue.completed, "failed": task_queue.failed})
+        outbox = extensions.get("outbox")
+        if outbox is not None:
+            labelled("mirai_outbox_total", "counter", "Outbound email delivery attempts by outcome.", "outcome",
+                     {"sent": outbox.sent, "retried": outbox.retried, "failed": outbox.failed})
+            scalar("mirai_smtp_connections_total", "counter", "SMTP connections opened.", outbox.connections)
+
+        from extraction import CACHE_SIZE, CACHE_STATS, OCR_STAGE_STATS, PDF_STATS
+        labelled("mirai_extraction_cache_total", "counter", "Extracted-text cache lookups by outcome.", "outcome",
+                 CACHE_STATS)
+        scalar("mirai_extraction_cache_bytes", "gauge", "Extracted-text cache size at the last sweep.",
+               CACHE_SIZE["bytes"])
+        scalar("mirai_extraction_cache_entries", "gauge", "Extracted-text cache entries at the last sweep.",
+               CACHE_SIZE["entries"])
+        scalar("mirai_pdf_documents_total", "counter", "PDFs extracted.", PDF_STATS["documents"])
+        scalar("mirai_pdf_sampled_total", "counter", "PDFs whose text PDF_SAMPLE_PAGES cut short.",
+               PDF_STATS["sampled"])
+        scalar("mirai_pdf_pages_read_total", "counter", "PDF pages extracted.", PDF_STATS["pages_read"])
+        ocr = sorted(OCR_STAGE_STATS.items())
+        family("mirai_ocr_stage_seconds", "summary", "OCR time per stage.",
+               [(f"mirai_ocr_stage_seconds_{part}", (("stage", stage),), value)
+                for stage, (count, total) in ocr for part, value in (("sum", total), ("count", count))])
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,138 @@
+# jobs.py -- background jobs run through extensions.task_queue
+import threading
+import time
+from flask import current_app
+from extensions import db, cache, metrics, task_queue
+from models import Chat, Attachment
+from extraction import (
+    ATTACHMENT_PROMPT_CHARS, cache_dir, cache_sweep_due, detect_kind, prune_cache, record_ocr_timings,
+    record_pdf_pages, submit_extraction,
+)
+from storage import attachment_path, collect_garbage
+from utils import generate_chat_title, summarize_conversation
+
+
+def title_chat(chat_id, prompt, username, user_id):
+    """Name a "New Chat" from its first prompt; leaves chats renamed meanwhile untouched."""
+    chat = db.session.get(Chat, chat_id)
+    if not chat or chat.name != "New Chat":
+        return
+    db.session.rollback()  # don't hold a connection during the model call
+
+    title = generate_chat_title(prompt, username)
+    if not title or title == "New Chat":
+        return
+
+    # conditional update: a rename or delete during generation wins
+    Chat.query.filter_by(id=chat_id, name="New Chat").update({"name": title[:100]})
+    db.session.commit()
+    cache.invalidate_chats(user_id)
+
+
+def extract_attachment(attachment_id):
+    """Pre-extract an upload's prompt text in the process pool. Doesn't wait for it: the outcome is
+    recorded on the row by record_extraction when the pool finishes, or expire_extraction after
+    EXTRACTION_TIMEOUT, so task threads stay free for titles and summaries."""
+    att = db.session.get(Attachment, attachment_id)
+    if not att:
+        return
+    file_path = attachment_path(att)
+    kind = detect_kind(att.filename, att.content_type)
+    db.session.rollback()  # don't hold a connection while the pool works
+
+    started = time.perf_counter()
+    try:
+        future = submit_extraction(file_path, kind, ATTACHMENT_PROMPT_CHARS, cache_dir(),
+                                   current_app.config.get("PDF_SAMPLE_PAGES"))
+    except Exception:
+        current_app.logger.exception("Extraction failed for attachment %s", attachment_id)
+        Attachment.query.filter_by(id=attachment_id).update({"extraction_status": "failed"})
+        db.session.commit()
+        return
+
+    timer = threading.Timer(current_app.config.get("EXTRACTION_TIMEOUT", 120),
+                            lambda: task_queue.enqueue(expire_extraction, attachment_id, future))
+    timer.daemon = True
+    timer.start()
+
+    def finished(done):  # runs on the pool's result thread: hand the DB work to the task queue
+        timer.cancel()
+        task_queue.enqueue(record_extraction, attachment_id, done, time.perf_counter() - started)
+    future.add_done_callback(finished)
+
+
+def record_extraction(attachment_id, future, seconds):
+    """Store a finished extraction's outcome (a crashed worker or a cancelled job counts as failed)."""
+    try:
+        digest, timings, pages = future.result()
+        values = {"content_hash": digest, "extraction_status": "done"}
+        metrics.observe("extract_file", seconds)
+        if pages:
+            record_pdf_pages(pages, f"attachment={attachment_id}")
+        if timings:
+            record_ocr_timings(timings)
+            current_app.logger.info("OCR attachment=%s %s", attachment_id,
+                                    " ".join(f"{k}_ms={v * 1000:.0f}" for k, v in timings.items()))
+    except Exception:  # also BrokenProcessPool (worker died) and CancelledError
+        current_app.logger.exception("Extraction failed for attachment %s", attachment_id)
+        values = {"extraction_status": "failed"}
+
+    Attachment.query.filter_by(id=attachment_id).update(values)
+    db.session.commit()
+    if cache_sweep_due(current_app.config.get("EXTRACTION_CACHE_SWEEP_INTERVAL", 3600)):
+        task_queue.enqueue_unique("prune_extraction_cache", prune_extraction_cache)
+
+
+def expire_extraction(attachment_id, future):
+    """EXTRACTION_TIMEOUT passed: stop waiting, so send_message extracts inline instead."""
+    if future.done():
+        return
+    future.cancel()  # only drops it if it hasn't started; a late result still lands via record_extraction
+    current_app.logger.warning("Extraction of attachment %s timed out", attachment_id)
+    Attachment.query.filter_by(id=attachment_id, extraction_status="pending").update({"extraction_status": "failed"})
+    db.session.commit()
+
+
+def summarize_chat(chat_id):
+    """Fold all but the newest SUMMARY_KEEP_RECENT unsummarized messages into Chat.summary.
+    Enqueued once per chat at a time (task_queue.enqueue_unique), so a backlog costs one model call."""
+    config = current_app.config
+    chat = db.session.get(Chat, chat_id)
+    if not chat:
+        return
+    rows = chat.recent_messages(config.get("MEMORY_MAX_MESSAGES", 40))
+    if len(rows) <= config.get("SUMMARY_THRESHOLD", 16):
+        return
+    folded = rows[:-config.get("SUMMARY_KEEP_RECENT", 6)]
+    turns = [m.as_turn() for m in folded]
+    upto = folded[-1].id
+    previous, previous_upto = chat.summary, chat.summary_message_id
+    db.session.rollback()  # don't hold a connection during the model call
+
+    summary = summarize_conversation(previous, turns)
+    if not summary:
+        return
+
+    # Conditional on the watermark: an overlapping job that already folded wins
+    Chat.query.filter_by(id=chat_id, summary_message_id=previous_upto).update(
+        {"summary": summary, "summary_message_id": upto})
+    db.session.commit()
+
+
+def collect_blobs():
+    """Free unreferenced upload blobs and abandoned chunked uploads (storage.collect_garbage),
+    and the extracted text cached for those blobs."""
+    blobs, sessions = collect_garbage()
+    if blobs or sessions:
+        current_app.logger.info("Storage GC: removed %s blobs, %s upload sessions", len(blobs), sessions)
+    prune_extraction_cache(blobs)
+
+
+def prune_extraction_cache(digests=()):
+    """Evict extraction cache entries (extraction.prune_cache): stale versions, `digests`, and
+    entries past EXTRACTION_CACHE_MAX_AGE / EXTRACTION_CACHE_MAX_BYTES."""
+    config = current_app.config
+    removed = prune_cache(cache_dir(), config.get("EXTRACTION_CACHE_MAX_BYTES"),
+                          config.get("EXTRACTION_CACHE_MAX_AGE"), digests)
+    if removed:
+        current_app.logger.info("Extraction cache: removed %s entries", removed)
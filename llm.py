@@ -0,0 +1,322 @@
+# llm.py
+import hashlib
+import json
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import current_app
+
+
+class GatewayBusy(Exception):
+    """Raised when a model call cannot be admitted (429 per-user, 503 global)."""
+
+    def __init__(self, message, status_code=503, retry_after=1):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+# gateway bucket for background calls (summaries, titles): capped together, not per user
+_BACKGROUND = object()
+
+
+class _Lease:
+    """One admitted model call; releases its slot exactly once."""
+
+    def __init__(self, gateway, user_id):
+        self._gateway = gateway
+        self._user_id = user_id
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._gateway._release(self._user_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class LLMGateway:
+    """
+    Admission control for outbound OpenRouter calls.
+    - max_concurrency: process-wide cap on in-flight calls; waiting longer than
+      queue_timeout for a slot raises GatewayBusy(503).
+    - max_per_user: per-user cap so one chat can't starve others; exceeding it
+      raises GatewayBusy(429) immediately.
+    - max_background: cap on background calls (acquire(background=True)), which don't
+      count against their user's interactive slots; exceeding it raises GatewayBusy(503).
+    Uses threading primitives: gunicorn runs gthread workers (WEB_THREADS request threads each),
+    since SQLite waits, inline extraction and the process pool block in C and would stall a gevent hub.
+    """
+
+    def __init__(self, app=None):
+        self.max_concurrency = 100
+        self.max_per_user = 2
+        self.max_background = 4
+        self.queue_timeout = 5.0
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+        self._per_user = {}
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_concurrency = app.config.get("LLM_MAX_CONCURRENCY", self.max_concurrency)
+        self.max_per_user = app.config.get("LLM_MAX_PER_USER", self.max_per_user)
+        self.max_background = app.config.get("LLM_MAX_BACKGROUND", self.max_background)
+        self.queue_timeout = app.config.get("LLM_QUEUE_TIMEOUT", self.queue_timeout)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        app.extensions["llm_gateway"] = self
+
+    def acquire(self, user_id=None, background=False):
+        """Admit one call or raise GatewayBusy. Use the returned lease as a context manager."""
+        bucket = _BACKGROUND if background else user_id
+        with self._lock:
+            active = self._per_user.get(bucket, 0)
+            if background and active >= self.max_background:
+                self.rejected += 1
+                raise GatewayBusy("Too many background model calls in progress.", 503)
+            if bucket is not None and not background and active >= self.max_per_user:
+                self.rejected += 1
+                raise GatewayBusy("You already have replies in progress. Please wait.", 429)
+            self._per_user[bucket] = active + 1
+            self.waiting += 1
+
+        admitted = self._slots.acquire(timeout=self.queue_timeout)
+        with self._lock:
+            self.waiting -= 1
+            if admitted:
+                self.in_flight += 1
+            else:
+                self._drop_user(bucket)
+                self.rejected += 1
+        if not admitted:
+            raise GatewayBusy("Mirai is busy right now. Please retry shortly.", 503,
+                              retry_after=max(1, int(self.queue_timeout)))
+        return _Lease(self, bucket)
+
+    def _release(self, user_id):
+        with self._lock:
+            self.in_flight -= 1
+            self._drop_user(user_id)
+        self._slots.release()
+
+    def _drop_user(self, user_id):
+        remaining = self._per_user.get(user_id, 1) - 1
+        if remaining > 0:
+            self._per_user[user_id] = remaining
+        else:
+            self._per_user.pop(user_id, None)
+
+
+# ---------------- response cache + in-flight coalescing ----------------
+class _InFlight:
+    """One upstream call that identical concurrent requests share; followers replay its chunks."""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.text = None  # final reply; stays None if the leader never got to call upstream
+        self._cond = threading.Condition()
+
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, text):
+        with self._cond:
+            self.done = True
+            self.text = text
+            self._cond.notify_all()
+
+    def follow(self, timeout):
+        """Yield the leader's chunks as they arrive; stops when it finishes or after `timeout`."""
+        deadline = time.monotonic() + timeout
+        seen = 0
+        while True:
+            with self._cond:
+                while seen == len(self.chunks) and not self.done:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    self._cond.wait(remaining)
+                fresh, finished = self.chunks[seen:], self.done
+                seen = len(self.chunks)
+            yield from fresh
+            if finished:
+                return
+
+
+class ResponseCache:
+    """
+    Optional reuse of chat replies (RESPONSE_CACHE_ENABLED).
+    - Finished replies are kept for RESPONSE_CACHE_TTL seconds, at most RESPONSE_CACHE_MAX_ENTRIES
+      (RESPONSE_CACHE_BACKEND: a cache.py backend; "memory" by default).
+    - Identical requests arriving while a reply is being generated wait for that call instead of
+      making their own (per process).
+    Keys hash (user, model, system prompt, normalized context, prompt); error replies aren't stored.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.follow_timeout = 60
+        self._backend = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        from cache import make_backend
+
+        self.enabled = app.config.get("RESPONSE_CACHE_ENABLED", False)
+        self.follow_timeout = app.config.get("OPENROUTER_READ_TIMEOUT", 30) * 2
+        self._backend = make_backend(app, app.config.get("RESPONSE_CACHE_BACKEND", "memory"),
+                                     ttl=app.config.get("RESPONSE_CACHE_TTL", 600),
+                                     max_entries=app.config.get("RESPONSE_CACHE_MAX_ENTRIES", 1000))
+        app.extensions["response_cache"] = self
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.coalesced + self.misses
+        return (self.hits + self.coalesced) / total if total else 0.0
+
+    @staticmethod
+    def key(user_id, model, system_messages, history, prompt):
+        """
+        Whitespace is collapsed, and trailing copies of this same prompt (plus the replies they
+        got) are dropped from the context, so a retry or double submit maps to the original key.
+        """
+        def norm(text):
+            return " ".join((text or "").split())
+
+        prompt = norm(prompt)
+        turns = [(t["role"], norm(t.get("content"))) for t in history]
+        while turns:
+            if turns[-1] == ("user", prompt):
+                turns.pop()
+            elif len(turns) >= 2 and turns[-1][0] == "assistant" and turns[-2] == ("user", prompt):
+                del turns[-2:]
+            else:
+                break
+        material = json.dumps([user_id, model, [norm(m["content"]) for m in system_messages], turns, prompt])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def claim(self, key):
+        """
+        ("hit", text) for a stored reply, ("follow", inflight) while an identical call runs, or
+        ("lead", inflight): the caller makes the call and must report back through complete().
+        """
+        if not self.enabled or key is None:
+            return "lead", None
+        text = self._backend.get(f"reply:{key}")
+        with self._lock:
+            if text is not None:
+                self.hits += 1
+                return "hit", text
+            inflight = self._inflight.get(key)
+            if inflight is not None:
+                self.coalesced += 1
+                return "follow", inflight
+            inflight = self._inflight[key] = _InFlight()
+            self.misses += 1
+            return "lead", inflight
+
+    def complete(self, key, inflight, text, store=True):
+        """Finish a led call: wake followers and (for good replies) store the text. text=None: abandoned."""
+        if inflight is None:
+            return
+        with self._lock:
+            if self._inflight.get(key) is inflight:
+                del self._inflight[key]
+        if text and store:
+            self._backend.set(f"reply:{key}", text)
+        inflight.finish(text)
+
+
+# ---------------- shared HTTP client ----------------
+_session = None
+_session_lock = threading.Lock()
+
+
+def _retry_policy(config):
+    """Retry connect errors and 429/5xx answers with exponential backoff plus jitter.
+    Read errors are not retried: the upstream may already be generating (and billing)."""
+    retries = config.get("OPENROUTER_MAX_RETRIES", 2)
+    options = dict(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset({"POST"}),
+        backoff_factor=config.get("OPENROUTER_RETRY_BACKOFF", 0.5),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    try:
+        return Retry(backoff_jitter=config.get("OPENROUTER_RETRY_JITTER", 0.5), **options)
+    except TypeError:  # urllib3 < 2 has no jitter support
+        return Retry(**options)
+
+
+def http_session():
+    """
+    Process-wide requests.Session for OpenRouter.
+    Keeps TLS connections alive across calls; created lazily so each gunicorn
+    worker builds its own pool after fork.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                config = current_app.config
+                # one kept-alive connection per admitted call: a smaller pool (pool_block=False)
+                # opens the extra connections anyway and discards them, handshake and all
+                concurrency = config.get("LLM_MAX_CONCURRENCY", 100)
+                pool_size = config.get("OPENROUTER_POOL_SIZE") or concurrency
+                if pool_size < concurrency:
+                    current_app.logger.warning("OPENROUTER_POOL_SIZE=%s is below LLM_MAX_CONCURRENCY=%s; using %s",
+                                               pool_size, concurrency, concurrency)
+                    pool_size = concurrency
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                      max_retries=_retry_policy(config))
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({"Connection": "keep-alive"})
+                _session = session
+    return _session
+
+
+def chat_completion(payload, timeout=None, stream=False):
+    """POST a chat-completions payload to OpenRouter over the shared session and return the raw response.
+    timeout is the read timeout in seconds (defaults to OPENROUTER_READ_TIMEOUT)."""
+    config = current_app.config
+    query_counter = current_app.extensions.get("query_counter")
+    if query_counter is not None:
+        query_counter.check_released("Model call")
+    return http_session().post(
+        config["OPENROUTER_API_URL"],
+        headers={
+            "Authorization": f"Bearer {config['OPENROUTER_API_KEY']}",
+            "Content-Type": "application/json"
+        },
+        json=payload,
+        stream=stream,
+        timeout=(config.get("OPENROUTER_CONNECT_TIMEOUT", 5), timeout or config.get("OPENROUTER_READ_TIMEOUT", 30))
+    )
@@ -0,0 +1,168 @@
+# mailer.py -- durable outbound email queue with a background sender
+import json
+import random
+import smtplib
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from flask_mail import Message
+
+
+class Outbox:
+    """
+    Outbound mail off the request path. enqueue() stores the message in the outbound_email
+    table and returns; a sender thread per process claims due rows in batches, sends them
+    over one SMTP connection kept open between batches (until MAIL_IDLE_TIMEOUT), and retries
+    failures with exponential backoff up to MAIL_MAX_ATTEMPTS. Rows are claimed with a lease,
+    so several workers can share the table and a crashed sender's rows are picked up again.
+    """
+
+    def __init__(self, app=None):
+        self._app = None
+        self._mail = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.connections = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self._mail = app.extensions["mail"]
+        app.extensions["outbox"] = self
+        if app.config.get("MAIL_QUEUE_WORKER", True):
+            app.before_request(self._ensure_worker)  # also picks up rows left by earlier processes
+
+        @app.cli.command("mail-queue")
+        def mail_queue():
+            """Show outbound email queue depth."""
+            for status, count in sorted(self.depth().items()):
+                print(f"{status:<10} {count}")
+
+    # ---------------- producer side ----------------
+    def enqueue(self, msg):
+        """Queue a flask_mail Message (committed here, so it survives a restart) and wake the sender."""
+        from extensions import db
+        from models import OutboundEmail
+
+        db.session.add(OutboundEmail(sender=msg.sender, recipients=json.dumps(list(msg.recipients)),
+                                     subject=msg.subject, body=msg.body, html=msg.html))
+        db.session.commit()
+        if self._app.config.get("MAIL_QUEUE_WORKER", True):
+            self._ensure_worker()
+            self._wake.set()
+
+    def depth(self):
+        """Row counts per status; 'queued' is the backlog (due now or waiting for a retry)."""
+        from extensions import db
+        from models import OutboundEmail
+
+        rows = db.session.query(OutboundEmail.status, db.func.count()).group_by(OutboundEmail.status)
+        return {status: count for status, count in rows}
+
+    # ---------------- sender ----------------
+    def _ensure_worker(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="mirai-mail", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        config = self._app.config
+        connection, last_used = None, 0.0
+        while True:
+            self._wake.clear()
+            batch = []
+            with self._app.app_context():
+                try:
+                    batch = self._claim(config.get("MAIL_BATCH_SIZE", 50), config.get("MAIL_SEND_LEASE", 300))
+                    if batch:
+                        connection = self._send_batch(connection, batch)
+                        last_used = time.monotonic()
+                except Exception:
+                    self._app.logger.exception("Mail sender loop failed")
+                    connection = self._close(connection)
+            if batch:
+                continue  # drain the backlog before sleeping
+            if connection is not None and time.monotonic() - last_used > config.get("MAIL_IDLE_TIMEOUT", 60):
+                connection = self._close(connection)
+            self._wake.wait(config.get("MAIL_POLL_INTERVAL", 5))
+
+    def _claim(self, limit, lease):
+        """Take up to `limit` due rows for this sender; until the lease ends nobody else will."""
+        from extensions import db
+        from models import OutboundEmail
+
+        now, token = datetime.utcnow(), uuid.uuid4().hex
+        due = (db.select(OutboundEmail.id)
+               .where(OutboundEmail.status == "queued", OutboundEmail.next_attempt_at <= now)
+               .order_by(OutboundEmail.id)
+               .limit(limit))
+        (OutboundEmail.query
+         .filter(OutboundEmail.id.in_(due), OutboundEmail.status == "queued", OutboundEmail.next_attempt_at <= now)
+         .update({"claim": token, "next_attempt_at": now + timedelta(seconds=lease)}, synchronize_session=False))
+        db.session.commit()
+        return OutboundEmail.query.filter_by(claim=token).order_by(OutboundEmail.id).all()
+
+    def _connect(self):
+        connection = self._mail.connect()
+        connection.__enter__()  # SMTP connect + STARTTLS + login, once for many messages
+        self.connections += 1
+        return connection
+
+    def _close(self, connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+    def _send_batch(self, connection, batch):
+        from extensions import db
+
+        try:
+            connection = connection or self._connect()
+        except Exception as e:  # server unreachable: the whole batch waits for its retry
+            for row in batch:
+                self._failed(row, e)
+            db.session.commit()
+            return None
+
+        for row in batch:
+            try:
+                connection = connection or self._connect()
+                connection.send(Message(subject=row.subject, sender=row.sender, recipients=json.loads(row.recipients),
+                                        body=row.body, html=row.html))
+                row.status, row.sent_at, row.claim = "sent", datetime.utcnow(), None
+                self.sent += 1
+            except Exception as e:
+                if not isinstance(e, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)):
+                    connection = self._close(connection)  # connection-level trouble: reconnect for the next one
+                self._failed(row, e)
+            db.session.commit()  # per message, so a crash never re-sends what already went out
+        return connection
+
+    def _failed(self, row, error):
+        config = self._app.config
+        row.attempts += 1
+        row.claim = None
+        row.last_error = f"{type(error).__name__}: {error}"[:1000]
+        # 5xx replies are permanent (bad address, rejected content); everything else is retried
+        permanent = isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500 \
+            or isinstance(error, smtplib.SMTPRecipientsRefused)
+        if permanent or row.attempts >= config.get("MAIL_MAX_ATTEMPTS", 6):
+            row.status = "failed"
+            self.failed += 1
+            self._app.logger.warning("Giving up on email %s to %s: %s", row.id, row.recipients, row.last_error)
+            return
+        backoff = config.get("MAIL_RETRY_BACKOFF", 30) * 2 ** (row.attempts - 1)
+        row.next_attempt_at = datetime.utcnow() + timedelta(seconds=backoff * random.uniform(1, 1.5))
+        self.retried += 1
@@ -0,0 +1,145 @@
+# migrations.py -- versioned schema upgrades for databases created by older releases
+from sqlalchemy import inspect, text
+
+# db.create_all() builds new databases straight at the latest schema, so every
+# step checks the live schema first and only changes what is missing.
+
+
+def _columns(conn, table):
+    return {col["name"] for col in inspect(conn).get_columns(table)}
+
+
+def _add_columns(conn, table, columns):
+    existing = _columns(conn, table)
+    for name, ddl in columns:
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+
+def _create_indexes(conn, indexes):
+    for name, table, cols in indexes:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(cols)})"))
+
+
+def _attachment_message_link(conn):
+    _add_columns(conn, "attachment", [("message_id", "INTEGER")])
+
+
+def _attachment_extraction(conn):
+    _add_columns(conn, "attachment", [("content_hash", "VARCHAR(64)"), ("extraction_status", "VARCHAR(16)")])
+
+
+def _chat_summary(conn):
+    _add_columns(conn, "chat", [("summary", "TEXT")])
+
+
+def _retire_chat_memory(conn):
+    _add_columns(conn, "chat", [("summary_message_id", "INTEGER")])
+    if "memory" in _columns(conn, "chat"):
+        conn.execute(text("ALTER TABLE chat DROP COLUMN memory"))  # SQLite 3.35+
+    _create_indexes(conn, [("ix_message_chat_id_id", "message", ["chat_id", "id"])])
+
+
+def _hot_path_indexes(conn):
+    _create_indexes(conn, [
+        ("ix_chat_user_id_created_at", "chat", ["user_id", "created_at"]),
+        ("ix_message_chat_id_timestamp", "message", ["chat_id", "timestamp"]),
+        ("ix_attachment_user_id", "attachment", ["user_id"]),
+        ("ix_attachment_chat_id", "attachment", ["chat_id"]),
+        ("ix_attachment_message_id", "attachment", ["message_id"]),
+    ])
+
+
+def _message_search(conn):
+    # FTS5 index over message text plus an "owner" token (u<user_id>), so a search is scoped to
+    # one user inside the index instead of ranking every user's matches and filtering afterwards.
+    # The text itself stays in message (external content, read through message_search_src).
+    # Prefix indexes keep search-as-you-type ("cat*") from expanding into thousands of terms.
+    # Other databases fall back to LIKE in search.py.
+    if conn.dialect.name != "sqlite":
+        return
+    conn.execute(text("CREATE VIEW IF NOT EXISTS message_search_src AS "
+                      "SELECT m.id, m.content, 'u' || c.user_id AS owner FROM message m JOIN chat c ON c.id = m.chat_id"))
+    conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+                      "content, owner, content='message_search_src', content_rowid='id', "
+                      "prefix='2 3', tokenize='unicode61 remove_diacritics 2')"))
+    owner = "(SELECT 'u' || user_id FROM chat WHERE id = {row}.chat_id)"
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS message_fts_ai AFTER INSERT ON message BEGIN "
+                      f"INSERT INTO message_fts(rowid, content, owner) VALUES (new.id, new.content, {owner.format(row='new')}); END"))
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS message_fts_ad AFTER DELETE ON message BEGIN "
+                      "INSERT INTO message_fts(message_fts, rowid, content, owner) "
+                      f"VALUES ('delete', old.id, old.content, {owner.format(row='old')}); END"))
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS message_fts_au AFTER UPDATE OF content ON message BEGIN "
+                      "INSERT INTO message_fts(message_fts, rowid, content, owner) "
+                      f"VALUES ('delete', old.id, old.content, {owner.format(row='old')}); "
+                      f"INSERT INTO message_fts(rowid, content, owner) VALUES (new.id, new.content, {owner.format(row='new')}); END"))
+    conn.execute(text("INSERT INTO message_fts(message_fts) VALUES ('rebuild')"))  # index existing history
+
+
+def _blob_storage(conn):
+    conn.execute(text("CREATE TABLE IF NOT EXISTS blob ("
+                      "sha256 VARCHAR(64) NOT NULL PRIMARY KEY, size BIGINT NOT NULL, refcount INTEGER NOT NULL, "
+                      "created_at DATETIME, last_used_at DATETIME)"))
+    conn.execute(text("CREATE TABLE IF NOT EXISTS upload_session ("
+                      "id VARCHAR(32) NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES user (id), "
+                      "chat_id INTEGER REFERENCES chat (id), filename VARCHAR(260) NOT NULL, "
+                      "content_type VARCHAR(128), size BIGINT NOT NULL, created_at DATETIME)"))
+    _add_columns(conn, "attachment", [("blob_sha256", "VARCHAR(64) REFERENCES blob (sha256)")])
+    _create_indexes(conn, [
+        ("ix_attachment_blob_sha256", "attachment", ["blob_sha256"]),
+        ("ix_upload_session_user_id", "upload_session", ["user_id"]),
+    ])
+
+
+def _outbound_email(conn):
+    conn.execute(text("CREATE TABLE IF NOT EXISTS outbound_email ("
+                      "id INTEGER NOT NULL PRIMARY KEY, sender VARCHAR(255), recipients TEXT NOT NULL, "
+                      "subject VARCHAR(255) NOT NULL, body TEXT, html TEXT, status VARCHAR(16) NOT NULL, "
+                      "attempts INTEGER NOT NULL, next_attempt_at DATETIME, claim VARCHAR(32), last_error TEXT, "
+                      "created_at DATETIME, sent_at DATETIME)"))
+    _create_indexes(conn, [
+        ("ix_outbound_email_status_next_attempt_at", "outbound_email", ["status", "next_attempt_at"]),
+    ])
+
+
+# (version, description, step) -- append only; never renumber released steps
+MIGRATIONS = [
+    (1, "attachment.message_id", _attachment_message_link),
+    (2, "attachment content hash + extraction status", _attachment_extraction),
+    (3, "chat.summary", _chat_summary),
+    (4, "chat.summary_message_id, drop chat.memory", _retire_chat_memory),
+    (5, "indexes for chat list, message history and attachments", _hot_path_indexes),
+    (6, "full-text search index on message content", _message_search),
+    (7, "content-addressed upload storage (blob, upload_session, attachment.blob_sha256)", _blob_storage),
+    (8, "outbound email queue", _outbound_email),
+]
+
+
+def current_version(conn):
+    conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+    return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+
+def upgrade_database(db):
+    """`flask db-upgrade`: tables a new database lacks are created at the latest schema, then
+    pending steps run (each one only changes what is missing). Needs an app context."""
+    import models  # noqa: F401  (registers every table on db.metadata)
+
+    db.create_all()
+    return upgrade(db.engine)
+
+
+def upgrade(engine):
+    """Apply pending migrations in order, each in its own transaction. Returns the resulting version."""
+    with engine.begin() as conn:
+        version = current_version(conn)
+
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+        print(f"⚙️ Migrating schema to v{number}: {description}")
+        with engine.begin() as conn:
+            step(conn)
+            conn.execute(text("INSERT INTO schema_version (version) VALUES (:v)"), {"v": number})
+        version = number
+    return version
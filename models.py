@@ -39,12 +39,42 @@ class Chat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), default="New Chat")
     created_at = db.Column(db.DateTime, server_default=db.func.now())
-    memory = db.Column(db.Text, default='[]')
+    summary = db.Column(db.Text, nullable=True)               # running summary of older turns
+    summary_message_id = db.Column(db.Integer, nullable=True)  # last Message.id folded into summary
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
     messages = db.relationship('Message', backref='chat', lazy=True, cascade="all, delete-orphan")
     attachments = db.relationship('Attachment', backref='chat_ref', lazy=True, cascade="all, delete-orphan")
 
+    __table_args__ = (
+        db.Index('ix_chat_user_id_created_at', 'user_id', 'created_at'),  # sidebar: user's chats, newest first
+    )
+
+    def recent_messages(self, limit):
+        """Last `limit` messages not yet folded into the summary, oldest first
+        (served by the (chat_id, id) index)."""
+        rows = (Message.query
+                .filter(Message.chat_id == self.id, Message.id > (self.summary_message_id or 0))
+                .order_by(Message.id.desc())
+                .limit(limit)
+                .all())
+        return rows[::-1]
+
+    def message_page(self, before=None, limit=50):
+        """
+        One page of history, oldest first: the `limit` messages with id < `before`
+        (the newest page when `before` is None). Keyset on (chat_id, id), so the cost
+        doesn't grow with how far back the page is. Returns (messages, has_more).
+        """
+        query = Message.query.filter(Message.chat_id == self.id)
+        if before is not None:
+            query = query.filter(Message.id < before)
+        rows = (query.options(db.selectinload(Message.attachments))
+                .order_by(Message.id.desc())
+                .limit(limit + 1)
+                .all())
+        return rows[:limit][::-1], len(rows) > limit
+
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -55,16 +85,84 @@ class Message(db.Model):
 
     attachments = db.relationship('Attachment', backref='message_ref', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_message_chat_id_id', 'chat_id', 'id'),                # last N by chat
+        db.Index('ix_message_chat_id_timestamp', 'chat_id', 'timestamp'),  # chat page, in time order
+    )
+
+    def as_turn(self):
+        """This message as a chat-completions turn."""
+        return {"role": "user" if self.sender == "user" else "assistant", "content": self.content}
+
 
 class Attachment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(260), nullable=False)
-    path = db.Column(db.String(1024), nullable=False)   # stored filename on disk (not absolute)
+    path = db.Column(db.String(1024), nullable=False)   # stored filename on disk (not absolute); see storage.attachment_path
     content_type = db.Column(db.String(128), nullable=True)
     upload_time = db.Column(db.DateTime, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=True)
-    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=True, index=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True, index=True)
+    content_hash = db.Column(db.String(64), nullable=True)        # sha256 of the stored bytes
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('blob.sha256'), nullable=True, index=True)  # None: legacy uploads/ file
+    extraction_status = db.Column(db.String(16), nullable=True)   # 'pending' | 'done' | 'failed' (None: not precomputed)
 
     def __repr__(self):
         return f"<Attachment {self.id} {self.filename}>"
+
+
+class Blob(db.Model):
+    """Stored upload content, shared by every Attachment with the same bytes (see storage.py)."""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)   # Attachment rows pointing here
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow)  # GC grace period starts here
+
+
+class UploadSession(db.Model):
+    """A resumable chunked upload in progress; the bytes so far live in storage.part_path(id)."""
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=True)
+    filename = db.Column(db.String(260), nullable=False)
+    content_type = db.Column(db.String(128), nullable=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class OutboundEmail(db.Model):
+    """A queued email; mailer.Outbox sends it in the background and records the outcome here."""
+    id = db.Column(db.Integer, primary_key=True)
+    sender = db.Column(db.String(255), nullable=True)
+    recipients = db.Column(db.Text, nullable=False)          # JSON list of addresses
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=True)
+    html = db.Column(db.Text, nullable=True)
+    status = db.Column(db.String(16), nullable=False, default="queued")  # 'queued' | 'sent' | 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)    # also the sender's lease while sending
+    claim = db.Column(db.String(32), nullable=True)                      # batch id of the sender holding the row
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_outbound_email_status_next_attempt_at', 'status', 'next_attempt_at'),  # due messages
+    )
+
+
+# Blob reference counts follow Attachment rows (including cascade deletes of chats/users)
+@db.event.listens_for(Attachment, "after_insert")
+def _attachment_inserted(mapper, connection, att):
+    if att.blob_sha256:
+        connection.execute(Blob.__table__.update().where(Blob.sha256 == att.blob_sha256)
+                           .values(refcount=Blob.refcount + 1))
+
+
+@db.event.listens_for(Attachment, "after_delete")
+def _attachment_deleted(mapper, connection, att):
+    if att.blob_sha256:
+        connection.execute(Blob.__table__.update().where(Blob.sha256 == att.blob_sha256)
+                           .values(refcount=Blob.refcount - 1))
@@ -1,29 +1,79 @@
 # routes.py
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session, current_app, send_from_directory
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, session, current_app, send_file, Response, stream_with_context, g
 from flask_login import login_user, logout_user, login_required, current_user
-from extensions import db, login_manager
-from models import User, Chat, Message, Attachment
+from extensions import db, login_manager, task_queue, cache, metrics
+from models import User, Chat, Message, Attachment, UploadSession
 from forms import RegisterForm, LoginForm, UsernameForm
 from utils import (
     send_verification_email,
     hash_password,
     verify_password,
-    generate_chat_title,
     generate_response,
+    stream_response,
     read_file_content,
     read_stored_file_content,  # <- added
 )
+from llm import GatewayBusy
+from jobs import title_chat, extract_attachment, summarize_chat, collect_blobs
+from extraction import ATTACHMENT_PROMPT_CHARS, needs_extraction
+from search import search_messages
+from exports import FORMATS, export_chunks, gzip_chunks
+from database import read_only
+from storage import UploadTooLarge, attachment_path, blob_relpath, ensure_blob, part_path, store_file, store_stream
 from itsdangerous import URLSafeTimedSerializer
 from sqlalchemy.exc import IntegrityError
-import json, os, uuid
+from sqlalchemy.orm import make_transient_to_detached
+import json, os, time, uuid
 from werkzeug.utils import secure_filename
 
 app_routes = Blueprint("app_routes", __name__)
 
 # ---------------- USER LOADER ----------------
+# Cached columns of the logged-in user; password_hash stays out of the cache and lazy-loads if touched
+USER_CACHE_COLUMNS = ("id", "email", "username", "is_confirmed")
+
+
+def _user_row(user_id):
+    user = db.session.get(User, user_id)
+    return {col: getattr(user, col) for col in USER_CACHE_COLUMNS} if user else None
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    if not cache.enabled:
+        return db.session.get(User, user_id)
+    row = cache.get_or_load("user", user_id, lambda: _user_row(user_id))
+    if row is None:
+        return None
+    # Rebuild the row as a persistent object without a SELECT, so writes (set_username, ...) still work
+    user = User(**row)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def _sidebar_chats(user_id):
+    """The user's chats for the sidebar, newest first, as {"id", "name"} dicts (cached)."""
+    def load():
+        rows = (db.session.query(Chat.id, Chat.name).filter_by(user_id=user_id)
+                .order_by(Chat.created_at.desc()).all())
+        return [{"id": r.id, "name": r.name} for r in rows]
+    return cache.get_or_load("chats", user_id, load)
+
+
+# ---------------- LLM BACKPRESSURE ----------------
+@app_routes.errorhandler(GatewayBusy)
+def llm_busy(e):
+    wants_json = request.is_json or any(t in (request.headers.get("Accept") or "")
+                                        for t in ("application/json", "text/event-stream"))
+    if wants_json:
+        resp = jsonify({"error": e.message})
+        resp.status_code = e.status_code
+    else:
+        flash(f"⚠️ {e.message}", "warning")
+        resp = redirect(url_for("app_routes.jarvis"))
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp
 
 
 # ---------------- HOME ----------------
@@ -72,6 +122,7 @@ def confirm_email(token):
     if not user.is_confirmed:
         user.is_confirmed = True
         db.session.commit()
+        cache.invalidate_user(user.id)
         login_user(user)  # Auto-login
         flash("✅ Email confirmed! Please set your username.", "success")
         return redirect(url_for("app_routes.set_username"))
@@ -126,6 +177,7 @@ def set_username():
 
         current_user.username = username
         db.session.commit()
+        cache.invalidate_user(current_user.id)
 
         flash("✅ Username set successfully!", "success")
         return redirect(url_for("app_routes.jarvis"))
@@ -143,48 +195,54 @@ def logout():
 
 
 # ---------------- MAIN CHAT PAGE ----------------
+# not @read_only: it creates the first chat when there is none, and right after /new_chat
+# redirects here a lagging replica wouldn't have the new chat yet
 @app_routes.route("/jarvis")
 @login_required
 def jarvis():
     if not current_user.username:
         return redirect(url_for("app_routes.set_username"))
 
-    user_chats = Chat.query.filter_by(user_id=current_user.id).order_by(Chat.created_at.desc()).all()
+    user_chats = _sidebar_chats(current_user.id) or []
 
     # Ensure at least one chat exists
     if not user_chats:
-        new_chat = Chat(name="New Chat", user_id=current_user.id, memory=json.dumps([]))
+        new_chat = Chat(name="New Chat", user_id=current_user.id)
         db.session.add(new_chat)
         db.session.commit()
-        user_chats.append(new_chat)
+        cache.invalidate_chats(current_user.id)
+        user_chats = [{"id": new_chat.id, "name": new_chat.name}]
 
-    active_chat_id = request.args.get("chat_id")
+    active_chat_id = request.args.get("chat_id", type=int)
     active_chat = None
     if active_chat_id:
-        try:
-            active_chat = Chat.query.filter_by(id=active_chat_id, user_id=current_user.id).first()
-        except Exception:
-            active_chat = None
+        active_chat = Chat.query.filter_by(id=active_chat_id, user_id=current_user.id).first()
 
     if not active_chat:
-        active_chat = user_chats[0]
+        active_chat = Chat.query.filter_by(id=user_chats[0]["id"], user_id=current_user.id).first()
+        if not active_chat:  # cached list outlived the chat (deleted from another worker)
+            cache.invalidate_chats(current_user.id)
+            return redirect(url_for("app_routes.jarvis"))
 
-    # safe: ensure messages is always a list
-    messages = Message.query.filter_by(chat_id=active_chat.id).order_by(Message.timestamp).all() if active_chat else []
+    # only the newest page; older history is fetched from /chats/<id>/messages on scroll
+    messages, has_more = active_chat.message_page(limit=current_app.config.get("MESSAGE_PAGE_SIZE", 50))
 
     return render_template("jarvis.html",
                            user=current_user,
                            chats=user_chats,
                            active_chat=active_chat,
                            active_chat_id=getattr(active_chat, "id", None),
-                           messages=messages)
+                           messages=messages,
+                           has_more=has_more)
 
 
-# ---------------- helper: upload folder ----------------
-def ensure_upload_folder():
-    upload_dir = os.path.join(current_app.instance_path, 'uploads')
-    os.makedirs(upload_dir, exist_ok=True)
-    return upload_dir
+def _await_extraction(att):
+    """Give a still-pending upload-time extraction a moment to land; afterwards
+    read_stored_file_content extracts inline as a fallback."""
+    deadline = time.monotonic() + current_app.config.get("EXTRACTION_WAIT_SECONDS", 3)
+    while att.extraction_status == "pending" and time.monotonic() < deadline:
+        time.sleep(0.2)
+        db.session.refresh(att)
 
 
 # ---------------- SEND MESSAGE (updated to handle attachments list) ----------------
@@ -195,6 +253,8 @@ def send_message(chat_id):
     user_msg = ""
     uploaded_content = ""
     attachments_ids = []
+    # Clients opt into token streaming with Accept: text/event-stream (or "stream": true in JSON)
+    wants_stream = "text/event-stream" in (request.headers.get("Accept") or "")
 
     # If multipart form (direct file + prompt form submit)
     if request.content_type and request.content_type.startswith("multipart/form-data"):
@@ -209,7 +269,12 @@ def send_message(chat_id):
         # JSON path (used by the frontend)
         data = request.get_json(silent=True) or {}
         user_msg = data.get("message", "") or ""
-        attachments_ids = [a.get("id") for a in (data.get("attachments") or []) if a.get("id")]
+        wants_stream = wants_stream or bool(data.get("stream"))
+        for a in (data.get("attachments") or []):
+            try:
+                attachments_ids.append(int(a.get("id")))
+            except (TypeError, ValueError, AttributeError):
+                continue
 
     # Build initial prompt (user text + any inline uploaded content)
     final_prompt = (user_msg + uploaded_content).strip()
@@ -218,28 +283,28 @@ def send_message(chat_id):
     if not final_prompt and not attachments_ids:
         return jsonify({"reply": ""})
 
-    # Build attachments text (extract/describe)
-    attachments_text_parts = []
+    # One IN (...) query for every referenced attachment the current user owns, in request order
+    attachments = []
     if attachments_ids:
-        for aid in attachments_ids:
-            try:
-                aid_int = int(aid)
-            except Exception:
-                continue
-            att = Attachment.query.get(aid_int)
-            if not att:
-                continue
-            # only process attachments owned by the current user
-            if att.user_id != current_user.id:
-                continue
+        with metrics.stage("attachments"):
+            owned = Attachment.query.filter(Attachment.id.in_(attachments_ids),
+                                            Attachment.user_id == current_user.id).all()
+        by_id = {att.id: att for att in owned}
+        attachments = [by_id[aid] for aid in dict.fromkeys(attachments_ids) if aid in by_id]
 
-            # read/ocr stored file (utils handles OCR fallback)
+    # Build attachments text (extract/describe)
+    attachments_text_parts = []
+    with metrics.stage("extraction"):
+        for att in attachments:
+            # read/ocr stored file (utils handles OCR fallback); usually a cache hit
+            # thanks to the upload-time extraction
+            _await_extraction(att)
             try:
-                snippet = read_stored_file_content(att, max_chars=4000)
+                snippet = read_stored_file_content(att, max_chars=ATTACHMENT_PROMPT_CHARS)
                 if snippet:
                     attachments_text_parts.append(snippet)
             except Exception as e:
-                current_app.logger.exception("Failed to read stored attachment %s: %s", aid_int, e)
+                current_app.logger.exception("Failed to read stored attachment %s: %s", att.id, e)
                 # fallback: include a filename/link
                 try:
                     url = url_for('app_routes.serve_file', file_id=att.id, _external=True)
@@ -252,52 +317,204 @@ def send_message(chat_id):
         attachments_block = "\n\n--- Attachments ---\n" + "\n\n".join(attachments_text_parts) + "\n--- End attachments ---\n"
         final_prompt = (final_prompt + "\n\n" + attachments_block).strip()
 
-    # Save user message (content includes any attachments text)
-    user_message = Message(content=final_prompt or user_msg, sender="user", chat_id=chat.id)
-    db.session.add(user_message)
-    db.session.flush()  # assign id to user_message so we can link attachments
+    # Conversation context: prior turns from the message table (indexed "last N by chat")
+    with metrics.stage("history"):
+        history = [m.as_turn() for m in chat.recent_messages(current_app.config.get("MEMORY_MAX_MESSAGES", 40))]
+
+    # Everything below works on plain values: after the commit the ORM objects are expired
+    # and touching one would check a connection out again (e.g. during the model call).
+    user_id = current_user.id
+    username = current_user.username or "User"
+    summary = chat.summary
+    needs_title = chat.name == "New Chat" and bool(user_msg)
+    # unsummarized turns once this exchange is stored
+    pending_turns = len(history) + 2
+
+    # Save user message (content includes any attachments text) in its own short transaction
+    with metrics.stage("commit_turn"):
+        user_message = Message(content=final_prompt or user_msg, sender="user", chat_id=chat_id)
+        db.session.add(user_message)
+        db.session.flush()  # assign id to user_message so we can link attachments
+
+        # Link attachments (already loaded and ownership-checked above) to this message & chat
+        for att in attachments:
+            att.chat_id = chat_id
+            att.message_id = user_message.id
+        message_id = user_message.id
+        db.session.commit()  # returns the connection (and SQLite's write lock) before the model call
 
-    # Link attachments (if any) to this message & chat (only if the uploader is the owner)
-    if attachments_ids:
-        for aid in attachments_ids:
-            try:
-                aid_int = int(aid)
-            except Exception:
-                continue
-            att = Attachment.query.get(aid_int)
-            if not att:
-                continue
-            if att.user_id != current_user.id:
-                continue
-            att.chat_id = chat.id
-            # ensure Attachment model has message_id column (migration/auto-add earlier)
-            try:
-                att.message_id = user_message.id
-            except Exception:
-                # if attribute doesn't exist (older DB), ignore silently
-                pass
-            db.session.add(att)
-
-    # Load chat memory
-    memory = json.loads(chat.memory or "[]")
-    memory.append({"role": "user", "content": final_prompt})
-
-    # Get AI response (the prompt now includes attachments text/captions)
-    ai_reply = generate_response(final_prompt, current_user.username or "User", memory)
-
-    ai_message = Message(content=ai_reply, sender="assistant", chat_id=chat.id)
-    db.session.add(ai_message)
-
-    # Update memory
-    memory.append({"role": "assistant", "content": ai_reply})
-    chat.memory = json.dumps(memory[-20:])  # keep last 20 turns
+    try:
+        if wants_stream:
+            # Admitted eagerly: GatewayBusy -> 429/503 before any output
+            chunks = stream_response(final_prompt, username, history, user_id=user_id, summary=summary)
+        else:
+            ai_reply = generate_response(final_prompt, username, history, user_id=user_id, summary=summary)
+    except GatewayBusy:
+        _discard_turn(message_id)  # not admitted: a retry must not store the prompt twice
+        raise
+
+    if wants_stream:
+        # the reply is saved once the stream finishes
+        return _stream_reply(chat_id, user_id, chunks, pending_turns, user_msg, username, needs_title,
+                             g.get("prompt_tokens"), reply_source=g.get("reply_source"))
+
+    current_app.logger.info("send_message chat=%s prompt_tokens=%s cached=%s",
+                            chat_id, g.get("prompt_tokens"), g.get("reply_source"))
+    _save_reply(chat_id, user_id, ai_reply, pending_turns, user_msg, username, needs_title)
+    return jsonify({"reply": ai_reply, "prompt_tokens": g.get("prompt_tokens"), "cached": g.get("reply_source")})
+
+
+def _discard_turn(message_id):
+    """Remove a stored user turn whose model call was refused; its attachments stay uploaded."""
+    Attachment.query.filter_by(message_id=message_id).update({"message_id": None})
+    Message.query.filter_by(id=message_id).delete()
+    db.session.commit()
 
-    # Auto-title
-    if chat.name == "New Chat" and user_msg:
-        chat.name = generate_chat_title(user_msg, current_user.username or "User")
 
-    db.session.commit()
-    return jsonify({"reply": ai_reply})
+def _save_reply(chat_id, user_id, ai_reply, pending_turns, user_msg, username, needs_title):
+    """Store the assistant reply (a second short transaction) and schedule titling/summarizing."""
+    if ai_reply:  # empty when a stream was cut off before its first chunk
+        with metrics.stage("commit_reply"):
+            db.session.add(Message(content=ai_reply, sender="assistant", chat_id=chat_id))
+            db.session.commit()
+
+    # Auto-title in the background; the page polls /chats/<id> for the name
+    if needs_title:
+        task_queue.enqueue(title_chat, chat_id, user_msg, username, user_id)
+    # older turns are folded into chat.summary in the background (one job per chat at a time)
+    if pending_turns > current_app.config.get("SUMMARY_THRESHOLD", 16):
+        task_queue.enqueue_unique(f"summarize:{chat_id}", summarize_chat, chat_id)
+
+
+def _sse(data, event=None):
+    """Format one Server-Sent Events frame."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+
+def _stream_reply(chat_id, user_id, chunks, pending_turns, user_msg, username, needs_title,
+                  prompt_tokens=None, reply_source=None):
+    """Relay model chunks to the browser as SSE, then persist the reply -- also the part streamed
+    before a client disconnect, which closes this generator (GeneratorExit) mid-stream."""
+    def events():
+        started = time.perf_counter()
+        ttft_ms = None
+        parts = []
+        finished = False
+        try:
+            for chunk in chunks:
+                if ttft_ms is None:
+                    ttft_ms = (time.perf_counter() - started) * 1000
+                parts.append(chunk)
+                yield _sse({"delta": chunk})
+            finished = True
+        finally:
+            if not finished and hasattr(chunks, "close"):
+                chunks.close()  # stop reading upstream and release the gateway slot
+            ai_reply = "".join(parts)
+            total_ms = (time.perf_counter() - started) * 1000
+            # ttft_ms stays None when no chunk arrived; a cached or coalesced reply's first chunk
+            # isn't upstream latency, so it gets its own stage
+            if ttft_ms is not None:
+                metrics.observe(f"ttft_{reply_source}" if reply_source else "ttft", ttft_ms / 1000)
+            metrics.observe("model", total_ms / 1000)
+            _save_reply(chat_id, user_id, ai_reply, pending_turns, user_msg, username, needs_title)
+            current_app.logger.info("send_message chat=%s prompt_tokens=%s ttft_ms=%s total_ms=%.0f cached=%s%s",
+                                    chat_id, prompt_tokens, "-" if ttft_ms is None else round(ttft_ms),
+                                    total_ms, reply_source,
+                                    "" if finished else " disconnected")
+        yield _sse({"reply": ai_reply, "prompt_tokens": prompt_tokens, "cached": reply_source,
+                    "ttft_ms": None if ttft_ms is None else round(ttft_ms), "total_ms": round(total_ms)},
+                   event="done")
+
+    response = Response(stream_with_context(events()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    if hasattr(chunks, "close"):
+        # events() closed before it started runs no finally: free the gateway slot here too
+        response.call_on_close(chunks.close)
+    return response
+
+
+# ---------------- CHAT INFO (XHR; picks up background titles) ----------------
+@app_routes.route("/chats/<int:chat_id>")
+@login_required
+def chat_info(chat_id):
+    chat = Chat.query.filter_by(id=chat_id, user_id=current_user.id).first_or_404()
+    return jsonify({"id": chat.id, "name": chat.name})
+
+
+# ---------------- MESSAGE HISTORY (XHR; keyset pagination) ----------------
+def _message_json(m):
+    return {
+        "id": m.id,
+        "sender": m.sender,
+        "content": m.content,
+        "timestamp": m.timestamp.isoformat() if m.timestamp else None,
+        "attachments": [{
+            "id": a.id,
+            "filename": a.filename,
+            "url": url_for("app_routes.serve_file", file_id=a.id),
+            "content_type": a.content_type,
+        } for a in m.attachments],
+    }
+
+
+@app_routes.route("/chats/<int:chat_id>/messages")
+@read_only
+@login_required
+def chat_messages(chat_id):
+    """Messages older than ?before=<message id> (newest page when omitted), oldest first."""
+    chat = Chat.query.filter_by(id=chat_id, user_id=current_user.id).first_or_404()
+    config = current_app.config
+    limit = request.args.get("limit", config.get("MESSAGE_PAGE_SIZE", 50), type=int)
+    limit = max(1, min(limit, config.get("MESSAGE_PAGE_MAX", 200)))
+    before = request.args.get("before", type=int)
+
+    messages, has_more = chat.message_page(before=before, limit=limit)
+    return jsonify({
+        "messages": [_message_json(m) for m in messages],
+        "has_more": has_more,
+        "next_before": messages[0].id if messages and has_more else None,
+    })
+
+
+# ---------------- SEARCH (XHR; all of the user's chats) ----------------
+@app_routes.route("/search")
+@read_only
+@login_required
+def search():
+    query = (request.args.get("q") or "").strip()
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = current_app.config.get("SEARCH_PAGE_SIZE", 20)
+    results, has_more = search_messages(current_user.id, query, limit=per_page, offset=(page - 1) * per_page,
+                                        window=current_app.config.get("SEARCH_RANK_WINDOW", 2000))
+    for r in results:
+        r["url"] = url_for("app_routes.jarvis", chat_id=r["chat_id"], _anchor=f"msg-{r['message_id']}")
+    return jsonify({"query": query, "page": page, "results": results, "has_more": has_more})
+
+
+# ---------------- EXPORT (streamed; one chat or the whole history) ----------------
+@app_routes.route("/chats/<int:chat_id>/export")
+@app_routes.route("/export", defaults={"chat_id": None})
+@read_only
+@login_required
+def export_chats(chat_id):
+    """?format=jsonl|md|json|txt (default jsonl), &gzip=1 to compress on the fly."""
+    if chat_id is not None:
+        Chat.query.filter_by(id=chat_id, user_id=current_user.id).first_or_404()
+    fmt = request.args.get("format", "jsonl").lower()
+    if fmt not in FORMATS:
+        return jsonify({"error": f"format must be one of: {', '.join(FORMATS)}"}), 400
+    mimetype, ext = FORMATS[fmt]
+
+    chunks = export_chunks(current_user.id, fmt, chat_id=chat_id,
+                           batch_size=current_app.config.get("EXPORT_BATCH_SIZE", 500))
+    filename = f"mirai_chat_{chat_id}.{ext}" if chat_id else f"mirai_history.{ext}"
+    if request.args.get("gzip") in ("1", "true"):
+        chunks, mimetype, filename = gzip_chunks(chunks), "application/gzip", filename + ".gz"
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"',
+                             "X-Accel-Buffering": "no"})
 
 
 # ---------------- RENAME CHAT (XHR-friendly) ----------------
@@ -314,6 +531,7 @@ def rename_chat(chat_id):
     if new_name:
         chat.name = new_name.strip()
         db.session.commit()
+        cache.invalidate_chats(chat.user_id)
 
     wants_json = request.is_json or ('application/json' in (request.headers.get('Accept') or ''))
     if wants_json:
@@ -332,58 +550,203 @@ def upload_file(chat_id):
     if not f or f.filename == '':
         return jsonify({'success': False, 'error': 'No selected file'}), 400
 
-    filename = secure_filename(f.filename)
-    ext = os.path.splitext(filename)[1] or ''
-    uniq = uuid.uuid4().hex
-    stored_name = f"{uniq}{ext}"
-    upload_dir = ensure_upload_folder()
-    save_path = os.path.join(upload_dir, stored_name)
-
     try:
-        f.save(save_path)
-    except Exception as e:
+        with metrics.stage("store"):
+            digest, size = store_stream(f.stream, current_app.config.get("MAX_UPLOAD_BYTES"))
+    except UploadTooLarge:
+        return jsonify({'success': False, 'error': 'File too large'}), 413
+    except Exception:
         current_app.logger.exception("Failed to save upload")
         return jsonify({'success': False, 'error': 'Could not save file'}), 500
 
-    att = Attachment(
-        filename=filename,
-        path=stored_name,
-        content_type=f.mimetype,
-        user_id=current_user.id,
-        chat_id=chat_id if chat_id else None
-    )
-    db.session.add(att)
-    db.session.commit()
+    att = _create_attachment(secure_filename(f.filename), f.mimetype, chat_id or None, digest, size)
+    return jsonify({'success': True, 'file': _file_json(att)}), 201
+
+
+def _create_attachment(filename, content_type, chat_id, digest, size):
+    """Attachment row for stored bytes (sharing the blob with any identical upload); queues extraction."""
+    eager = needs_extraction(filename, content_type)
+    with metrics.stage("commit"):
+        ensure_blob(digest, size)
+        att = Attachment(
+            filename=filename,
+            path=blob_relpath(digest),
+            content_type=content_type,
+            user_id=current_user.id,
+            chat_id=chat_id,
+            content_hash=digest,
+            blob_sha256=digest,
+            extraction_status="pending" if eager else None
+        )
+        db.session.add(att)
+        db.session.commit()
+
+    # Parse/OCR now, while the user is still typing, instead of inside send_message
+    if eager:
+        task_queue.enqueue(extract_attachment, att.id)
+    return att
 
-    file_url = url_for('app_routes.serve_file', file_id=att.id, _external=False)
-    return jsonify({'success': True, 'file': {
+
+def _file_json(att):
+    return {
         'id': att.id,
         'filename': att.filename,
-        'url': file_url,
+        'url': url_for('app_routes.serve_file', file_id=att.id, _external=False),
         'content_type': att.content_type
-    }}), 201
+    }
+
+
+# ---------------- CHUNKED UPLOADS (resumable; large files) ----------------
+@app_routes.route("/uploads", methods=["POST"])
+@login_required
+def start_upload():
+    """Open an upload session: JSON {filename, size, content_type?, chat_id?} -> {upload_id, chunk_size}."""
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get("filename") or "")
+    size = data.get("size")
+    if not filename or not isinstance(size, int) or size < 0:
+        return jsonify({'success': False, 'error': 'filename and size are required'}), 400
+    if size > current_app.config.get("MAX_UPLOAD_BYTES", size):
+        return jsonify({'success': False, 'error': 'File too large'}), 413
+
+    chat_id = data.get("chat_id") or None
+    if chat_id is not None and not Chat.query.filter_by(id=chat_id, user_id=current_user.id).first():
+        return jsonify({'success': False, 'error': 'Chat not found'}), 404
+
+    upload = UploadSession(id=uuid.uuid4().hex, user_id=current_user.id, chat_id=chat_id, filename=filename,
+                           content_type=data.get("content_type") or None, size=size)
+    db.session.add(upload)
+    db.session.commit()
+    open(part_path(upload.id), "wb").close()
+    return jsonify({'upload_id': upload.id, 'received': 0,
+                    'chunk_size': current_app.config.get("UPLOAD_CHUNK_BYTES")}), 201
+
+
+def _own_upload(upload_id):
+    return UploadSession.query.filter_by(id=upload_id, user_id=current_user.id).first_or_404()
+
+
+def _received(upload_id):
+    try:
+        return os.path.getsize(part_path(upload_id))
+    except FileNotFoundError:
+        return 0
+
+
+@app_routes.route("/uploads/<upload_id>")
+@login_required
+def upload_status(upload_id):
+    """Bytes stored so far; a client resumes from here after a dropped connection."""
+    upload = _own_upload(upload_id)
+    return jsonify({'upload_id': upload.id, 'received': _received(upload.id), 'size': upload.size})
+
+
+@app_routes.route("/uploads/<upload_id>", methods=["PUT"])
+@login_required
+def upload_chunk(upload_id):
+    """
+    Raw body = bytes [offset, offset + Content-Length) of the file. Re-sending a chunk is
+    harmless; a gap (offset beyond what was received) is rejected with the resume point.
+    The chunk completing the file turns the session into an Attachment (same reply as /upload_file).
+    """
+    upload = _own_upload(upload_id)
+    upload_id, size = upload.id, upload.size
+    filename, content_type, chat_id = upload.filename, upload.content_type, upload.chat_id
+    offset = request.args.get("offset", type=int)
+    length = request.content_length
+    received = _received(upload_id)
+    if offset is None or offset < 0 or length is None:
+        return jsonify({'success': False, 'error': 'offset and Content-Length are required'}), 400
+    if offset > received:
+        return jsonify({'success': False, 'error': 'Chunk out of order', 'received': received}), 409
+    if offset + length > size:
+        return jsonify({'success': False, 'error': 'Chunk beyond declared size'}), 400
+
+    db.session.rollback()  # no transaction held while the body streams in
+    with open(part_path(upload_id), "r+b") as out:
+        out.seek(offset)
+        for chunk in iter(lambda: request.stream.read(1024 * 1024), b""):
+            out.write(chunk)
+    received = _received(upload_id)
+    if received < size:
+        return jsonify({'upload_id': upload_id, 'received': received, 'size': size})
+
+    # Complete: exactly one request wins the session and stores the file
+    if not UploadSession.query.filter_by(id=upload_id).delete(synchronize_session=False):
+        return jsonify({'success': False, 'error': 'Upload already completed'}), 409
+    db.session.commit()
+    if chat_id is not None and not Chat.query.filter_by(id=chat_id, user_id=current_user.id).first():
+        chat_id = None  # chat deleted while the upload was running
+    with metrics.stage("store"):
+        digest, size = store_file(part_path(upload_id))
+    att = _create_attachment(filename, content_type, chat_id, digest, size)
+    return jsonify({'success': True, 'file': _file_json(att)}), 201
 
 
 # ---------------- SERVE FILE ----------------
+def _file_cache_headers(resp, etag, immutable):
+    """Strong ETag from the content hash; blobs never change under their hash, so browsers may keep
+    them for FILE_CACHE_MAX_AGE without revalidating. Private: files belong to the logged-in user."""
+    if etag:
+        resp.set_etag(etag)
+    resp.cache_control.public = None
+    resp.cache_control.private = True
+    if immutable:
+        resp.cache_control.no_cache = None
+        resp.cache_control.max_age = current_app.config.get("FILE_CACHE_MAX_AGE", 31536000)
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.no_cache = True
+    return resp
+
+
 @app_routes.route("/files/<int:file_id>")
+@read_only
 @login_required
 def serve_file(file_id):
-    att = Attachment.query.get_or_404(file_id)
+    """
+    Attachment bytes with ETag/If-None-Match and Range (206) support. Revalidations are answered
+    from the row alone (no disk access); with X_ACCEL_REDIRECT_PREFIX (nginx) or USE_X_SENDFILE
+    (Apache/lighttpd) the proxy sends the bytes and the worker only returns headers.
+    """
+    att = (Attachment.query
+           .with_entities(Attachment.user_id, Attachment.path, Attachment.blob_sha256, Attachment.content_hash,
+                          Attachment.content_type, Attachment.filename)
+           .filter(Attachment.id == file_id)
+           .first_or_404())
     if att.user_id != current_user.id:
         return jsonify({'success': False, 'error': 'Forbidden'}), 403
 
-    upload_dir = os.path.join(current_app.instance_path, 'uploads')
-    disk_name = att.path
-    return send_from_directory(upload_dir, disk_name, as_attachment=False, download_name=att.filename)
+    etag = att.content_hash  # None for older uploads not yet hashed: Werkzeug's mtime/size ETag then
+    immutable = att.blob_sha256 is not None
+    if etag and request.if_none_match.contains_weak(etag):
+        return _file_cache_headers(current_app.response_class(status=304), etag, immutable)
+
+    path = attachment_path(att)
+    if not os.path.isfile(path):
+        return jsonify({'success': False, 'error': 'File missing'}), 404
+
+    accel_prefix = current_app.config.get("X_ACCEL_REDIRECT_PREFIX")
+    if accel_prefix and immutable:
+        # nginx serves (and range-slices) the blob from an internal location mapped onto BLOB_STORAGE_DIR
+        resp = current_app.response_class(mimetype=att.content_type or "application/octet-stream")
+        resp.headers["X-Accel-Redirect"] = f"{accel_prefix.rstrip('/')}/{blob_relpath(att.blob_sha256)}"
+        resp.headers.set("Content-Disposition", "inline", filename=att.filename)
+        return _file_cache_headers(resp, etag, immutable)
+
+    resp = send_file(path, mimetype=att.content_type, as_attachment=False, download_name=att.filename,
+                     etag=etag or True, conditional=True)
+    return _file_cache_headers(resp, etag, immutable)
 
 
 # ---------------- NEW CHAT ----------------
 @app_routes.route("/new_chat", methods=["POST"])
 @login_required
 def new_chat():
-    new_chat = Chat(name="New Chat", user_id=current_user.id, memory=json.dumps([]))
+    new_chat = Chat(name="New Chat", user_id=current_user.id)
     db.session.add(new_chat)
     db.session.commit()
+    cache.invalidate_chats(current_user.id)
     return redirect(url_for("app_routes.jarvis", chat_id=new_chat.id))
 
 
@@ -397,12 +760,15 @@ def delete_chat(chat_id):
 
     db.session.delete(chat)
     db.session.commit()
+    cache.invalidate_chats(current_user.id)
+    task_queue.enqueue(collect_blobs)  # its attachments may have held the last reference to a blob
 
-    remaining = Chat.query.filter_by(user_id=current_user.id).all()
+    remaining = Chat.query.filter_by(user_id=current_user.id).first()
     if not remaining:
-        new_chat = Chat(name="New Chat", user_id=current_user.id, memory=json.dumps([]))
+        new_chat = Chat(name="New Chat", user_id=current_user.id)
         db.session.add(new_chat)
         db.session.commit()
+        cache.invalidate_chats(current_user.id)
         return jsonify({"redirect": url_for("app_routes.jarvis", chat_id=new_chat.id)})
 
     return jsonify({"redirect": url_for("app_routes.jarvis")})
@@ -422,22 +788,29 @@ def upload_chat():
     file_content = read_file_content(file)
     combined_input = f"{prompt.strip()}\n\n{file_content}".strip() if prompt else file_content
 
-    short_title = generate_chat_title(combined_input[:500], current_user.username)
-
-    new_chat = Chat(user_id=current_user.id, name=short_title, memory=json.dumps([]))
+    # Chat and user turn in one short transaction; no connection is held during the model call
+    user_id, username = current_user.id, current_user.username
+    new_chat = Chat(user_id=user_id, name="New Chat")
     db.session.add(new_chat)
+    db.session.flush()
+    chat_id = new_chat.id
+    db.session.add(Message(chat_id=chat_id, sender="user", content=combined_input))
     db.session.commit()
 
-    user_msg = Message(chat_id=new_chat.id, sender="user", content=combined_input)
-    db.session.add(user_msg)
-
-    reply = generate_response(combined_input, current_user.username, memory=[])
-    bot_msg = Message(chat_id=new_chat.id, sender="assistant", content=reply)
-    db.session.add(bot_msg)
-
+    try:
+        reply = generate_response(combined_input, username, memory=[], user_id=user_id)
+    except GatewayBusy:
+        # not admitted: drop the new chat instead of leaving one with an unanswered turn
+        Message.query.filter_by(chat_id=chat_id).delete()
+        Chat.query.filter_by(id=chat_id).delete()
+        db.session.commit()
+        raise
+    db.session.add(Message(chat_id=chat_id, sender="assistant", content=reply))
     db.session.commit()
+    cache.invalidate_chats(user_id)
+    task_queue.enqueue(title_chat, chat_id, combined_input[:500], username, user_id)
 
-    return redirect(url_for("app_routes.jarvis", chat_id=new_chat.id))
+    return redirect(url_for("app_routes.jarvis", chat_id=chat_id))
 
 
 # ---------------- VERIFY EMAIL (alt) ----------------
@@ -450,6 +823,7 @@ def verify_email(token):
 
     user.is_confirmed = True
     db.session.commit()
+    cache.invalidate_user(user.id)
 
     flash("✅ Email verified! Now set your username.", "success")
     return redirect(url_for("app_routes.set_username"))
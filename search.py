@@ -0,0 +1,96 @@
+# search.py -- full-text search over a user's messages (SQLite FTS5, see migrations v6)
+import re
+from markupsafe import escape
+from sqlalchemy import inspect, text
+from extensions import db
+
+SNIPPET_TOKENS = 12
+# snippet() markers; swapped for <mark> after escaping so message text can't inject HTML
+_OPEN, _CLOSE = "\x02", "\x03"
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+# Candidates come from the owner-scoped index (see migrations v6), newest first, capped at
+# :window so a very common term doesn't bm25-rank a heavy user's whole history; the window is
+# then ordered by relevance. bm25 weights: content only (every candidate has the owner token).
+_FTS_SQL = text(f"""
+    SELECT m.id, m.chat_id, c.name AS chat_name, m.sender, m.timestamp, hit.snippet
+    FROM (SELECT rowid AS id, bm25(message_fts, 1.0, 0.0) AS score,
+                 snippet(message_fts, 0, '{_OPEN}', '{_CLOSE}', '…', {SNIPPET_TOKENS}) AS snippet
+          FROM message_fts WHERE message_fts MATCH :match
+          ORDER BY rowid DESC LIMIT :window) AS hit
+    JOIN message m ON m.id = hit.id
+    JOIN chat c ON c.id = m.chat_id
+    WHERE c.user_id = :user_id
+    ORDER BY hit.score
+    LIMIT :limit OFFSET :offset
+""")
+
+_LIKE_SQL = text("""
+    SELECT m.id, m.chat_id, c.name AS chat_name, m.sender, m.timestamp, m.content AS snippet
+    FROM message m JOIN chat c ON c.id = m.chat_id
+    WHERE c.user_id = :user_id AND m.content LIKE :pattern ESCAPE '\\'
+    ORDER BY m.id DESC
+    LIMIT :limit OFFSET :offset
+""")
+
+_fts_tables = {}  # engine url -> bool
+
+
+def fts_query(user_id, query):
+    """
+    User input -> FTS5 MATCH expression over one user's messages: every word must appear,
+    the last one as a prefix (search-as-you-type). Words are quoted, so FTS operators in the
+    input are inert.
+    """
+    words = _WORD.findall(query or "")
+    if not words:
+        return None
+    terms = [f'"{w}"' for w in words]
+    if len(words[-1]) >= 2:  # shorter prefixes aren't indexed (prefix='2 3') and match nearly everything
+        terms[-1] += "*"
+    return f'owner:"u{int(user_id)}" AND content:({" ".join(terms)})'
+
+
+def like_pattern(query):
+    """Substring LIKE pattern for the no-FTS fallback; %, _ and \\ in the input match literally."""
+    literal = query.strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{literal}%"
+
+
+def fts_available():
+    url = str(db.engine.url)
+    if url not in _fts_tables:
+        _fts_tables[url] = "message_fts" in inspect(db.engine).get_table_names()
+    return _fts_tables[url]
+
+
+def _snippet_html(snippet):
+    return str(escape(snippet)).replace(_OPEN, "<mark>").replace(_CLOSE, "</mark>")
+
+
+def search_messages(user_id, query, limit=20, offset=0, window=2000):
+    """
+    Best matches first (bm25) across all of the user's chats, ranked among the newest
+    `window` matches. Returns (results, has_more).
+    """
+    match = fts_query(user_id, query)
+    if not match:
+        return [], False
+
+    use_fts = fts_available()
+    if use_fts:
+        rows = db.session.execute(_FTS_SQL, {"match": match, "user_id": user_id, "window": window,
+                                             "limit": limit + 1, "offset": offset}).all()
+    else:
+        rows = db.session.execute(_LIKE_SQL, {"pattern": like_pattern(query), "user_id": user_id,
+                                              "limit": limit + 1, "offset": offset}).all()
+
+    results = [{
+        "message_id": row.id,
+        "chat_id": row.chat_id,
+        "chat_name": row.chat_name,
+        "sender": row.sender,
+        "timestamp": str(row.timestamp) if row.timestamp else None,
+        "snippet_html": _snippet_html(row.snippet if use_fts else row.snippet[:200]),
+    } for row in rows[:limit]]
+    return results, len(rows) > limit
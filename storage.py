@@ -0,0 +1,147 @@
+# storage.py -- content-addressed upload storage: streamed, hashed, deduplicated, sharded blobs
+import hashlib
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from extensions import db
+from models import Blob, UploadSession
+
+CHUNK_BYTES = 1024 * 1024
+
+
+def blob_root():
+    return current_app.config.get("BLOB_STORAGE_DIR") or os.path.join(current_app.instance_path, "blobs")
+
+
+def blob_relpath(digest):
+    # two levels of hash-prefix shards: at most 65536 directories, each holding a handful of files
+    return os.path.join(digest[:2], digest[2:4], digest)
+
+
+def blob_path(digest):
+    return os.path.join(blob_root(), blob_relpath(digest))
+
+
+def incoming_dir():
+    path = os.path.join(blob_root(), "incoming")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def part_path(session_id):
+    """Bytes received so far for a chunked upload session."""
+    return os.path.join(incoming_dir(), f"{session_id}.part")
+
+
+def attachment_path(att):
+    """Absolute path of an attachment's bytes (blob store, or instance/uploads for pre-blob rows)."""
+    if att.blob_sha256:
+        return blob_path(att.blob_sha256)
+    return os.path.join(current_app.instance_path, "uploads", att.path)
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def _publish(tmp_path, digest):
+    """Move a fully written temp file to its blob path. Identical content may already be there;
+    replacing it is harmless and refreshes the mtime that collect_garbage checks."""
+    target = blob_path(digest)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(tmp_path, target)
+
+
+def store_stream(stream, max_bytes=None):
+    """
+    Copy a binary stream into the blob store in 1 MB chunks, hashing as it goes, so
+    memory stays flat whatever the file size. Returns (hex sha256, size); raises
+    UploadTooLarge (leaving nothing behind) once more than max_bytes arrive.
+    """
+    digest, size = hashlib.sha256(), 0
+    fd, tmp_path = tempfile.mkstemp(dir=incoming_dir(), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: stream.read(CHUNK_BYTES), b""):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                digest.update(chunk)
+                out.write(chunk)
+        hexdigest = digest.hexdigest()
+        _publish(tmp_path, hexdigest)
+        return hexdigest, size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def store_file(path):
+    """Hash a finished part file and move it into the blob store. Returns (hex sha256, size)."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_BYTES), b""):
+            digest.update(chunk)
+    hexdigest = digest.hexdigest()
+    size = os.path.getsize(path)
+    _publish(path, hexdigest)
+    return hexdigest, size
+
+
+def ensure_blob(digest, size):
+    """Get-or-create the Blob row (in the caller's transaction). Its refcount is kept
+    by the Attachment insert/delete events in models.py."""
+    blob = db.session.get(Blob, digest)
+    if blob is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(Blob(sha256=digest, size=size, refcount=0))
+        except IntegrityError:  # a concurrent upload of the same bytes got there first
+            pass
+        blob = db.session.get(Blob, digest)
+    blob.last_used_at = datetime.utcnow()
+    return blob
+
+
+def collect_garbage():
+    """
+    Delete unreferenced blobs (refcount 0, unused for BLOB_GC_GRACE seconds) and abandoned
+    chunked uploads (older than UPLOAD_SESSION_TTL). Returns (digests of removed blobs, sessions removed).
+    """
+    config = current_app.config
+    grace = config.get("BLOB_GC_GRACE", 3600)
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+
+    removed = []
+    candidates = [b.sha256 for b in Blob.query.filter(Blob.refcount <= 0, Blob.last_used_at < cutoff)]
+    db.session.rollback()
+    for digest in candidates:
+        # conditional delete: an upload may have re-referenced the blob since we looked
+        deleted = Blob.query.filter(Blob.sha256 == digest, Blob.refcount <= 0,
+                                    Blob.last_used_at < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        if not deleted:
+            continue
+        path = blob_path(digest)
+        try:
+            # a just-published copy (fresh mtime) belongs to an upload that is about to re-create the row
+            if os.path.getmtime(path) < time.time() - grace:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        removed.append(digest)
+
+    stale = datetime.utcnow() - timedelta(seconds=config.get("UPLOAD_SESSION_TTL", 86400))
+    session_ids = [s.id for s in UploadSession.query.filter(UploadSession.created_at < stale)]
+    UploadSession.query.filter(UploadSession.id.in_(session_ids)).delete(synchronize_session=False)
+    db.session.commit()
+    for session_id in session_ids:
+        try:
+            os.remove(part_path(session_id))
+        except FileNotFoundError:
+            pass
+    return removed, len(session_ids)
@@ -0,0 +1,88 @@
+# tasks.py
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.utils import import_string
+
+
+class ThreadBackend:
+    """In-process worker pool (default)."""
+
+    def __init__(self, app):
+        self._pool = ThreadPoolExecutor(max_workers=app.config.get("TASK_WORKERS", 4),
+                                        thread_name_prefix="mirai-task")
+
+    def submit(self, fn):
+        self._pool.submit(fn)
+
+
+class SyncBackend:
+    """Runs tasks inline in the calling request; useful when debugging."""
+
+    def __init__(self, app):
+        pass
+
+    def submit(self, fn):
+        fn()
+
+
+BACKENDS = {"thread": ThreadBackend, "sync": SyncBackend}
+
+
+class TaskQueue:
+    """
+    Deferrable work (chat titling etc.) that must not sit on the request path.
+    Tasks run inside an app context, so they can use db.session and current_app.
+    TASK_BACKEND picks "thread", "sync", or an import path ("pkg.module:Backend")
+    to any class taking the app and exposing submit(fn).
+    """
+
+    def __init__(self, app=None):
+        self._app = None
+        self._backend = None
+        self._lock = threading.Lock()
+        self._keys = set()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        name = app.config.get("TASK_BACKEND", "thread")
+        backend_cls = BACKENDS.get(name) or import_string(name.replace(":", "."))
+        self._app = app
+        self._backend = backend_cls(app)
+        app.extensions["task_queue"] = self
+
+    def enqueue(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs); pass ids, not ORM objects (they belong to the request session)."""
+        with self._lock:
+            self.pending += 1
+        self._backend.submit(lambda: self._run(fn, args, kwargs))
+
+    def enqueue_unique(self, key, fn, *args, **kwargs):
+        """Like enqueue, but skipped while a task with the same key is queued or running in this
+        process. Returns whether it was scheduled."""
+        with self._lock:
+            if key in self._keys:
+                return False
+            self._keys.add(key)
+            self.pending += 1
+        self._backend.submit(lambda: self._run(fn, args, kwargs, key))
+        return True
+
+    def _run(self, fn, args, kwargs, key=None):
+        ok = False
+        with self._app.app_context():
+            try:
+                fn(*args, **kwargs)
+                ok = True
+            except Exception:
+                self._app.logger.exception("Background task %s failed", getattr(fn, "__name__", fn))
+        with self._lock:
+            self._keys.discard(key)
+            self.pending -= 1
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
@@ -1,28 +1,18 @@
 # utils.py
-import os
-import requests
-import docx
-import PyPDF2
-from flask import current_app, url_for, flash, render_template_string
+import json
+from flask import current_app, url_for, render_template_string, g
 from flask_mail import Message
 from itsdangerous import URLSafeTimedSerializer
 from werkzeug.security import generate_password_hash, check_password_hash
-
-# optional OCR support
-try:
-    from PIL import Image
-    import pytesseract
-    from io import BytesIO
-    OCR_AVAILABLE = True
-except Exception:
-    OCR_AVAILABLE = False
+from llm import GatewayBusy, chat_completion
+from context import build_context, condense_attachments
+from extraction import MAX_OCR_CHARS, OCR_AVAILABLE, read_file_content, read_stored_file_content
 
 MAX_AI_RESPONSE_CHARS = 500  # max characters for concise AI answers
-MAX_OCR_CHARS = 1000         # max chars extracted from images
 
 
 def send_verification_email(user):
-    from extensions import mail
+    from extensions import outbox
 
     serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
     token = serializer.dumps(user.email, salt='email-confirm')
@@ -53,11 +43,8 @@ This link will expire in 1 hour.
     msg.body = text_body
     msg.html = html_body
 
-    try:
-        mail.send(msg)
-    except Exception as e:
-        print(f"❌ Failed to send email: {e}")
-        flash("⚠️ Failed to send confirmation email.", "danger")
+    # Queued, not sent: the background sender delivers it (and retries) off the request path
+    outbox.enqueue(msg)
 
 
 def hash_password(password):
@@ -68,86 +55,20 @@ def verify_password(password, hashed):
     return check_password_hash(hashed, password)
 
 
-def read_stored_file_content(attachment, max_chars=MAX_OCR_CHARS):
-    """
-    Read a stored file (PDF, DOCX, TXT, or image) from server.
-    For images:
-        - Uses OCR if available.
-        - If OCR fails, returns a short description.
-    Returns a string to include in AI prompt.
-    """
-    upload_dir = os.path.join(current_app.instance_path, "uploads")
-    stored_name = getattr(attachment, "path", None) or getattr(attachment, "stored_name", None)
-    if not stored_name:
-        return ""
-
-    file_path = os.path.join(upload_dir, stored_name)
-    filename = getattr(attachment, "filename", stored_name)
-    ctype = (getattr(attachment, "content_type", "") or "").lower()
+CHAT_MODEL = "meta-llama/llama-3-8b-instruct"
 
-    if not os.path.exists(file_path):
-        return f"[Attachment: {filename}] (file missing)"
 
-    try:
-        # TXT
-        if ctype.startswith("text") or filename.lower().endswith(".txt"):
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as fh:
-                return fh.read(max_chars)
-
-        # PDF
-        if filename.lower().endswith(".pdf") or ctype == "application/pdf":
-            try:
-                with open(file_path, "rb") as fh:
-                    reader = PyPDF2.PdfReader(fh)
-                    text = " ".join((page.extract_text() or "") for page in reader.pages)
-                return text[:max_chars]
-            except Exception:
-                return f"[PDF: {filename}] (unable to parse)"
-
-        # DOCX
-        if filename.lower().endswith(".docx") or ctype in ("application/vnd.openxmlformats-officedocument.wordprocessingml.document",):
-            try:
-                doc = docx.Document(file_path)
-                text = "\n".join(para.text for para in doc.paragraphs)
-                return text[:max_chars]
-            except Exception:
-                return f"[DOCX: {filename}] (unable to parse)"
-
-        # Images
-        image_exts = (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".tif", ".webp", ".gif")
-        if filename.lower().endswith(image_exts) or ctype.startswith("image"):
-            if OCR_AVAILABLE:
-                try:
-                    img = Image.open(file_path)
-                    if img.mode not in ("RGB", "L"):
-                        img = img.convert("RGB")
-                    ocr_text = pytesseract.image_to_string(img).strip()
-                    if ocr_text:
-                        return ocr_text[:max_chars]
-                except Exception:
-                    pass
-            # fallback description
-            return f"[Image: {filename}] Description: An image is attached. Possibly contains objects or scenes. AI should consider this in the response."
-
-        return f"[Attachment: {filename}] (unsupported type)"
-
-    except Exception:
-        return f"[Attachment: {filename}] (unreadable)"
-
-
-def generate_response(user_msg, username, memory=None, attachment=None):
+def _build_chat_messages(user_msg, username, memory=None, attachment=None, summary=None, user_id=None):
     """
-    Generates a short response from Mirai AI.
-    - attachment: optional Attachment object; content will be included.
+    Assemble the system prompt, conversation summary, memory and user turn sent to the chat model,
+    fitted into CONTEXT_TOKEN_BUDGET. The estimated prompt size is left in
+    g.prompt_tokens for the caller to report. Returns (messages, response cache key).
     """
-    if memory is None:
-        memory = []
+    from extensions import response_cache
 
-    messages = memory.copy()
     system_prompt = f"""You are Mirai, assistant for {username}.
 Provide short, concise, and clear answers (max {MAX_AI_RESPONSE_CHARS} characters).
 Be polite and safe. Incorporate any relevant info from attachments."""
-    messages.insert(0, {"role": "system", "content": system_prompt})
 
     user_content = user_msg
     if attachment:
@@ -155,96 +76,285 @@ Be polite and safe. Incorporate any relevant info from attachments."""
         if ocr_text:
             user_content += f"\n\n[Attachment content]: {ocr_text}"
 
-    messages.append({"role": "user", "content": user_content})
+    system_messages = [{"role": "system", "content": system_prompt}]
+    if summary:
+        system_messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+
+    messages, prompt_tokens = build_context(
+        system_messages,
+        memory or [],
+        {"role": "user", "content": user_content},
+        current_app.config.get("CONTEXT_TOKEN_BUDGET", 3000),
+    )
+    g.prompt_tokens = prompt_tokens
+    key = None
+    if response_cache.enabled:
+        key = response_cache.key(user_id, CHAT_MODEL, system_messages, memory or [], user_content)
+    return messages, key
+
+
+def _claim_reply(key):
+    """Response-cache lookup before admission: ("hit", text), ("follow", inflight) or ("lead", inflight)."""
+    from extensions import response_cache
+
+    state, value = response_cache.claim(key)
+    g.reply_source = {"hit": "cache", "follow": "coalesced"}.get(state)
+    return state, value
+
+
+def _admit(user_id, key, inflight):
+    """Gateway lease for a led call; a rejected leader releases its followers (they retry themselves)."""
+    from extensions import llm_gateway, response_cache
 
     try:
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": "meta-llama/llama-3-8b-instruct",
-                "messages": messages,
-                "max_tokens": MAX_AI_RESPONSE_CHARS // 4
-            },
-            timeout=30
-        )
+        return llm_gateway.acquire(user_id)
+    except GatewayBusy:
+        response_cache.complete(key, inflight, None)
+        raise
+
+
+def generate_response(user_msg, username, memory=None, attachment=None, user_id=None, summary=None):
+    """
+    Generates a short response from Mirai AI.
+    - attachment: optional Attachment object; content will be included.
+    - user_id: admits the call through the LLM gateway (raises GatewayBusy when saturated).
+    - summary: running summary of turns no longer in memory.
+    With RESPONSE_CACHE_ENABLED, a repeated or concurrent identical request reuses the reply
+    (g.reply_source is "cache" / "coalesced").
+    """
+    from extensions import metrics, response_cache
+
+    with metrics.stage("context"):
+        messages, key = _build_chat_messages(user_msg, username, memory, attachment, summary, user_id)
+
+    state, value = _claim_reply(key)
+    if state == "hit":
+        return value
+    if state == "follow":
+        text = "".join(value.follow(response_cache.follow_timeout))
+        if value.text:
+            return value.text
+        if text:
+            return text
+        g.reply_source, value = None, None  # leader gave up before calling upstream: call ourselves
+
+    reply, ok = None, False
+    try:
+        with metrics.stage("admission"):
+            lease = _admit(user_id, key, value)
+        with lease, metrics.stage("model"):
+            reply, ok = _complete_reply(messages)
+    finally:
+        response_cache.complete(key, value, reply, store=ok)
+    return reply
+
+
+def _complete_reply(messages):
+    """One blocking chat completion; returns (text, ok)."""
+    try:
+        response = chat_completion({
+            "model": CHAT_MODEL,
+            "messages": messages,
+            "max_tokens": MAX_AI_RESPONSE_CHARS // 4
+        })
         data = response.json()
         if "choices" in data and len(data["choices"]) > 0:
-            return data["choices"][0]["message"]["content"][:MAX_AI_RESPONSE_CHARS]
-        return "⚠️ No response from AI."
+            return data["choices"][0]["message"]["content"][:MAX_AI_RESPONSE_CHARS], True
+        return "⚠️ No response from AI.", False
     except Exception as e:
         current_app.logger.exception("AI error: %s", e)
-        return "⚠️ Error contacting AI."
+        return "⚠️ Error contacting AI.", False
+
+
+def stream_response(user_msg, username, memory=None, attachment=None, user_id=None, summary=None):
+    """
+    Streaming variant of generate_response.
+    Admission through the LLM gateway happens eagerly (so GatewayBusy is raised
+    before any output); returns an iterator of text chunks as OpenRouter produces
+    them (``stream: true``), capped at MAX_AI_RESPONSE_CHARS like the blocking call.
+    Close it if it may not be exhausted: that frees the gateway slot, even before the first chunk.
+    Cached replies come back as a single chunk; coalesced ones replay the shared call's chunks.
+    """
+    from extensions import metrics
+
+    with metrics.stage("context"):
+        messages, key = _build_chat_messages(user_msg, username, memory, attachment, summary, user_id)
+
+    state, value = _claim_reply(key)
+    if state == "hit":
+        return iter([value])
+    if state == "follow":
+        return _follow_chunks(value, messages, user_id)
+    with metrics.stage("admission"):
+        lease = _admit(user_id, key, value)
+    return _LeasedStream(lease, messages, key, value)
+
+
+class _LeasedStream:
+    """
+    Chunks of an admitted streaming call. A generator closed before its first next() never runs
+    its body (so no `with lease` / finally): close() then releases the lease and abandons the
+    in-flight entry itself, otherwise it closes the generator, whose finally does both.
+    """
+
+    def __init__(self, lease, messages, key=None, inflight=None):
+        self._lease = lease
+        self._key = key
+        self._inflight = inflight
+        self._chunks = _stream_chunks(lease, messages, key, inflight)
+        self._started = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._started = True
+        return next(self._chunks)
+
+    def close(self):
+        from extensions import response_cache
+
+        self._chunks.close()
+        if not self._started:
+            self._lease.release()
+            response_cache.complete(self._key, self._inflight, None)
+            self._started = True  # settled; a second close is a no-op
+
+
+def _follow_chunks(inflight, messages, user_id):
+    from extensions import llm_gateway, response_cache
+
+    emitted = False
+    for chunk in inflight.follow(response_cache.follow_timeout):
+        emitted = True
+        yield chunk
+    if emitted:
+        return
+    # the leader gave up before calling upstream: make the call ourselves
+    try:
+        lease = llm_gateway.acquire(user_id)
+    except GatewayBusy as e:
+        yield f"⚠️ {e.message}"
+        return
+    yield from _stream_chunks(lease, messages)
+
+
+def _stream_chunks(lease, messages, key=None, inflight=None):
+    from extensions import response_cache
+
+    emitted = 0
+    parts = []
+    ok = False
+    with lease:
+        try:
+            response = chat_completion({
+                "model": CHAT_MODEL,
+                "messages": messages,
+                "max_tokens": MAX_AI_RESPONSE_CHARS // 4,
+                "stream": True
+            }, stream=True)
+            with response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    # SSE: skip keep-alive comments (": OPENROUTER PROCESSING") and blank lines
+                    if not line or not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        break
+                    try:
+                        choices = json.loads(payload).get("choices") or []
+                    except ValueError:
+                        continue
+                    if not choices:
+                        continue
+                    chunk = (choices[0].get("delta") or {}).get("content") or ""
+                    if not chunk:
+                        continue
+                    chunk = chunk[:MAX_AI_RESPONSE_CHARS - emitted]
+                    emitted += len(chunk)
+                    parts.append(chunk)
+                    if inflight is not None:
+                        inflight.publish(chunk)
+                    yield chunk
+                    if emitted >= MAX_AI_RESPONSE_CHARS:
+                        break
+            ok = bool(emitted)
+            if not emitted:
+                parts.append("⚠️ No response from AI.")
+                if inflight is not None:
+                    inflight.publish(parts[-1])
+                yield parts[-1]
+        except Exception as e:
+            current_app.logger.exception("AI stream error: %s", e)
+            if not emitted:
+                parts.append("⚠️ Error contacting AI.")
+                if inflight is not None:
+                    inflight.publish(parts[-1])
+                yield parts[-1]
+        finally:
+            # also runs when the client disconnects mid-stream (GeneratorExit): partial replies aren't stored
+            response_cache.complete(key, inflight, "".join(parts) or None, store=ok)
 
 
 def generate_chat_title(prompt, username="User"):
+    """Short chat name from the first prompt; admitted in the gateway's background bucket,
+    so it doesn't take a slot from the user's next reply."""
+    from extensions import llm_gateway
+
     try:
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}",
-                "Content-Type": "application/json"
-            },
-            json={
+        lease = llm_gateway.acquire(background=True)
+    except GatewayBusy:
+        return "New Chat"  # keep the placeholder so a later message retries titling
+
+    with lease:
+        try:
+            response = chat_completion({
                 "model": "meta-llama/llama-4-maverick",
                 "messages": [
                     {"role": "system", "content": "Generate a short title (max 3 words) for this chat. Give only title."},
                     {"role": "user", "content": prompt}
                 ]
-            },
-            timeout=15
-        )
-        data = response.json()
-        if "choices" in data and len(data["choices"]) > 0:
-            return data["choices"][0]["message"]["content"].strip()
-        return "Untitled Chat"
-    except Exception:
-        return "Untitled Chat"
+            }, timeout=current_app.config.get("OPENROUTER_TITLE_TIMEOUT", 15))
+            data = response.json()
+            if "choices" in data and len(data["choices"]) > 0:
+                return data["choices"][0]["message"]["content"].strip()
+            return "Untitled Chat"
+        except Exception:
+            return "Untitled Chat"
+
 
+def summarize_conversation(previous_summary, turns):
+    """
+    Fold `turns` (chat messages) into the running summary.
+    Returns the new summary, or None if the model couldn't be reached (caller retries later).
+    Runs in the gateway's background bucket, so it never takes one of the user's reply slots.
+    """
+    from extensions import llm_gateway
+
+    transcript = "\n".join(f"{t['role']}: {condense_attachments(t['content'])}" for t in turns)
+    prompt = f"Current summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{transcript}"
 
-def read_file_content(file_storage, max_chars=MAX_OCR_CHARS):
-    """Read uploaded FileStorage object (TXT, PDF, DOCX, Image)"""
-    filename = (getattr(file_storage, "filename", "") or "").lower()
-    ctype = (getattr(file_storage, "mimetype", "") or "").lower()
     try:
-        # TXT
-        if filename.endswith(".txt") or ctype.startswith("text"):
-            file_storage.stream.seek(0)
-            text = file_storage.read().decode("utf-8", errors="ignore")
-            file_storage.stream.seek(0)
-            return text[:max_chars]
-
-        # PDF
-        if filename.endswith(".pdf") or ctype == "application/pdf":
-            file_storage.stream.seek(0)
-            reader = PyPDF2.PdfReader(file_storage)
-            text = " ".join((page.extract_text() or "") for page in reader.pages)
-            file_storage.stream.seek(0)
-            return text[:max_chars]
-
-        # DOCX
-        if filename.endswith(".docx") or ctype in ("application/vnd.openxmlformats-officedocument.wordprocessingml.document",):
-            file_storage.stream.seek(0)
-            doc = docx.Document(file_storage)
-            text = "\n".join(para.text for para in doc.paragraphs)
-            file_storage.stream.seek(0)
-            return text[:max_chars]
-
-        # Image
-        image_exts = (".png", ".jpg", ".jpeg", ".bmp", ".tiff", ".tif", ".webp", ".gif")
-        if filename.endswith(image_exts) or ctype.startswith("image"):
-            if OCR_AVAILABLE:
-                file_storage.stream.seek(0)
-                from io import BytesIO
-                img = Image.open(BytesIO(file_storage.read()))
-                file_storage.stream.seek(0)
-                if img.mode not in ("RGB", "L"):
-                    img = img.convert("RGB")
-                text = pytesseract.image_to_string(img).strip()
-                return text[:max_chars]
-            return ""
-    except Exception:
-        return "[Unreadable content]"
+        lease = llm_gateway.acquire(background=True)
+    except GatewayBusy:
+        return None
+
+    with lease:
+        try:
+            response = chat_completion({
+                "model": CHAT_MODEL,
+                "messages": [
+                    {"role": "system", "content": "Update the running summary of this conversation with the new turns. "
+                                                  "Keep facts, names, decisions and open questions. Max 150 words. Give only the summary."},
+                    {"role": "user", "content": prompt}
+                ],
+                "max_tokens": 300
+            })
+            data = response.json()
+            if "choices" in data and len(data["choices"]) > 0:
+                return data["choices"][0]["message"]["content"].strip() or None
+            return None
+        except Exception as e:
+            current_app.logger.exception("Summary error: %s", e)
+            return None